@@ -1,4 +1,11 @@
-"""This function loads the previously done analysis."""
+"""This function loads the previously done analysis.
+
+With a memory budget (out-of-core mode) the raw movie is decoded straight in a
+new entry of the raw data cache and given as read only memory maps, so that
+it never needs to fit in memory. Without it, the memory needed is estimated
+first (see MemoryPlanner): the out-of-core mode is chosen if the analysis does
+not fit in memory, and nothing is loaded if it does not fit at all.
+"""
 
 
 import os
@@ -6,31 +13,78 @@ import numpy as np
 from PyQt5 import QtWidgets
 
 import MultiLoadCzi5D
+import FramesIndex
+import RawDataCache
+import MemoryPlanner
+import LinkedFiles
 
 
 class RawData:
     """Load raw data file."""
-    def __init__(self, foldername):
+    def __init__(self, foldername, fnames=None, memory_budget=None, processes=None):
+
+        if fnames is None:                                                                                  # raw files are asked to the user only when not given (GUI)
+            fnames  =  QtWidgets.QFileDialog.getOpenFileNames(None, "Select czi (or lsm) data files to concatenate...", foldername, filter="*.lsm *.czi *.tif *.lif")[0]
+        if memory_budget is None:
+            memory_budget  =  MemoryPlanner.MemoryPlanner(foldername, fnames, processes).plan()                                        # from the headers only: MemoryError before any decoding
+        nucs_spts_ch  =  np.fromfile(LinkedFiles.resolve(foldername, 'nucs_spts_ch.bin'), 'uint16')                               # files of the analysis, also when linked from another folder
+        crop_vect     =  np.load(LinkedFiles.resolve(foldername, 'crop_vect.npy')) if os.path.isfile(LinkedFiles.resolve(foldername, 'crop_vect.npy')) else None
+        im_red_smpl   =  np.load(LinkedFiles.resolve(foldername, 'im_red_smpl.npy'))
+        raw_cache     =  RawDataCache.RawDataCache()
+        cache_key     =  raw_cache.key(fnames, nucs_spts_ch, crop_vect, im_red_smpl)
+        cached        =  raw_cache.load(cache_key)
+
+        if cached is not None:                                                                                              # matrices already decoded by a previous load, memory mapped from the local cache
+            mtxs, info     =  cached
+            imarray_green  =  mtxs["imarray_green"]
+            imarray_red    =  mtxs["imarray_red"]
+            green4D        =  mtxs["green4D"]
+            pix_size       =  info["pix_size"]
+            pix_size_Z     =  info["pix_size_Z"]
+            time_step      =  info["time_step_value"]
+            crop_vect      =  np.array(info["crop_vect"])
 
-        fnames       =  QtWidgets.QFileDialog.getOpenFileNames(None, "Select czi (or lsm) data files to concatenate...", foldername, filter="*.lsm *.czi *.tif *.lif")[0]
-        raw_data     =  MultiLoadCzi5D.MultiProcLoadCzi5D(fnames, np.fromfile(foldername + '/nucs_spts_ch.bin', 'uint16'))
-        if os.path.isfile(foldername + '/crop_vect.npy'):
-            crop_vect  =  np.load(foldername + '/crop_vect.npy')
         else:
-            crop_vect  =  np.array([0, 0, raw_data.imarray_red.shape[1], raw_data.imarray_red.shape[2]])
+            frames_index  =  FramesIndex.FramesIndex(foldername, fnames, nucs_spts_ch, crop_vect)                             # fingerprints of the red frames, saved by a previous load of the same raw files
+            red_data      =  None
+            if frames_index.fingerprints is None:
+                red_data  =  MultiLoadCzi5D.MultiProcLoadCzi5D(fnames, nucs_spts_ch, crop_vect, load_green=False, processes=processes)               # first pass, only the red channel cropped, to find the analyzed frames
+                frames_index.save(red_data.red_fingerprints, red_data.imarray_red.dtype)
+
+            jj_start  =  frames_index.find(im_red_smpl[0])                                                                    # comparison of fingerprints, no arithmetic on the whole movie
+            jj_end    =  frames_index.find(im_red_smpl[1])
+            red_wndw  =  None if red_data is None else red_data.imarray_red[jj_start:jj_end + 1].copy()                      # copy of the analyzed frames only: the whole first pass movie is freed before the second pass
+            del red_data
 
-        raw_data.imarray_green  =  raw_data.imarray_green[:, crop_vect[0]:crop_vect[2], crop_vect[1]:crop_vect[3]]
-        raw_data.imarray_red    =  raw_data.imarray_red[:, crop_vect[0]:crop_vect[2], crop_vect[1]:crop_vect[3]]
-        raw_data.green4D        =  raw_data.green4D[:, :, crop_vect[0]:crop_vect[2], crop_vect[1]:crop_vect[3]]
+            out_folder  =  raw_cache.new_entry() if memory_budget is not None else None                                       # out-of-core: matrices are written in the cache, window by window
+            raw_data    =  MultiLoadCzi5D.MultiProcLoadCzi5D(fnames, nucs_spts_ch, crop_vect, [jj_start, jj_end + 1], load_red=red_wndw is None, out_folder=out_folder, memory_budget=memory_budget, processes=processes)     # only the frame window in the crop, red too if no first pass was done
+            if crop_vect is None:
+                crop_vect  =  np.array([0, 0, raw_data.green4D.shape[2], raw_data.green4D.shape[3]])
 
-        im_red_smpl  =  np.load(foldername + '/im_red_smpl.npy')
-        jj_start     =  np.where(np.sum(raw_data.imarray_red - im_red_smpl[0], axis=(1, 2)) == 0)[0][0]
-        jj_end       =  np.where(np.sum(raw_data.imarray_red - im_red_smpl[1], axis=(1, 2)) == 0)[0][0]
+            imarray_green  =  raw_data.imarray_green
+            imarray_red    =  raw_data.imarray_red if red_wndw is None else red_wndw
+            green4D        =  raw_data.green4D
+            pix_size       =  raw_data.pix_size
+            pix_size_Z     =  raw_data.pix_size_Z
+            time_step      =  raw_data.time_step_value
+            info           =  {"pix_size": pix_size, "pix_size_Z": pix_size_Z, "time_step_value": time_step, "crop_vect": np.asarray(crop_vect).tolist()}
+            if out_folder is None:
+                raw_cache.store(cache_key, {"imarray_green": imarray_green, "imarray_red": imarray_red, "green4D": green4D}, info)
+            else:
+                if red_wndw is not None:
+                    np.save(out_folder + '/imarray_red.npy', imarray_red)
+                del raw_data, imarray_green, imarray_red, red_wndw, green4D                                                            # no write mode map left open in the folder (it could not be renamed on Windows), written matrices are mapped again from the committed entry
+                mtxs, _        =  raw_cache.open_entry(raw_cache.commit(out_folder, cache_key, info, keep=True))
+                imarray_green  =  mtxs["imarray_green"]
+                imarray_red    =  mtxs["imarray_red"]
+                green4D        =  mtxs["green4D"]
 
-        self.imarray_green  =  raw_data.imarray_green[jj_start:jj_end + 1]
-        self.imarray_red    =  raw_data.imarray_red[jj_start:jj_end + 1]
-        self.green4D        =  raw_data.green4D[jj_start:jj_end + 1]
-        self.pix_size       =  raw_data.pix_size
-        self.pix_size_Z     =  raw_data.pix_size_Z
+        self.imarray_green  =  imarray_green
+        self.imarray_red    =  imarray_red
+        self.green4D        =  green4D
+        self.pix_size       =  pix_size
+        self.pix_size_Z     =  pix_size_Z
+        self.time_step      =  time_step
         self.fnames         =  fnames
         self.crop_vect      =  crop_vect
+        self.memory_budget  =  memory_budget
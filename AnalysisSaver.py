@@ -1,10 +1,14 @@
 """This function writes the analysis done.
 
 It saves all the matrices in .bin files, saves a .avi file and a file journal
-wit all the information needed about the activation.
+wit all the information needed about the activation. With a memory budget
+(out-of-core mode) the false colored video is built and written window by
+window in a memory mapped tiff file. Tracked spots, intensities and volumes
+are saved as sparse columns (see SparseSpots), their dense .npy files are an
+optional export. The unchanged inputs of the analysis (nuclei, crop, sample
+frames, channels) are copied or, to save disk space, linked (see LinkedFiles).
 """
 
-import shutil
 import os
 import datetime
 import numpy as np
@@ -12,24 +16,25 @@ import tifffile
 import pyqtgraph as pg
 import xlsxwriter
 from openpyxl import load_workbook
-from skimage.measure import regionprops
 
 import SpotsConnection
 import NucleiSpotsConnection
 import WriteSptsIntsDividedByBkg
+import SpotsPixelIndex
+import TimeChunks
+import MemoryPlanner
+import SparseSpots
+import LinkedFiles
 
 
 class FilteredSpotsSaver:
     """Save a parallel analysis folder with the filtered spots."""
-    def __init__(self, analysis_folder, spots_3D, fnames, green4D, solidity_thr_value, numb_zeros_frst_value, numb_zeros_scnd_value, numb_zeros_thrd_value, slot_strt_frst_value, slot_end_frst_value, slot_strt_scnd_value, slot_end_scnd_value, slot_strt_thrd_value, slot_end_thrd_value):
+    def __init__(self, analysis_folder, spots_3D, fnames, green4D, solidity_thr_value, numb_zeros_frst_value, numb_zeros_scnd_value, numb_zeros_thrd_value, slot_strt_frst_value, slot_end_frst_value, slot_strt_scnd_value, slot_end_scnd_value, slot_strt_thrd_value, slot_end_thrd_value, workers=None, show_plot=True, memory_budget=None, dense_export=True, link_mode="copy"):
 
         parallel_folder  =  analysis_folder + "_SpotsFiltered"
         os.mkdir(parallel_folder)
         print(parallel_folder)
-        shutil.copyfile(analysis_folder + '/crop_vect.npy', parallel_folder + '/crop_vect.npy')
-        shutil.copyfile(analysis_folder + '/im_red_smpl.npy', parallel_folder + '/im_red_smpl.npy')
-        shutil.copyfile(analysis_folder + '/nuclei_tracked.npy', parallel_folder + '/nuclei_tracked.npy')
-        shutil.copyfile(analysis_folder + '/nucs_spts_ch.bin', parallel_folder + '/nucs_spts_ch.bin')
+        LinkedFiles.link_files(analysis_folder, parallel_folder, ['crop_vect.npy', 'im_red_smpl.npy', 'nuclei_tracked.npy', 'nucs_spts_ch.bin'], link_mode)      # unchanged inputs: copied, linked or listed in a manifest
 
         book                   =  load_workbook(analysis_folder + '/journal.xlsx')
         software_version       =  book.worksheets[0]["B24"].value
@@ -50,33 +55,49 @@ class FilteredSpotsSaver:
         pix_size_Z             =  book.worksheets[0]["B17"].value
         t_track_end_value      =  book.worksheets[0]["B18"].value
 
-        nuclei_tracked    =  np.load(analysis_folder + '/nuclei_tracked.npy')
-        spots_tracked     =  SpotsConnection.SpotsConnection(nuclei_tracked, np.sign(spots_3D.spots_vol), max_dist).spots_tracked
-        nuc_active        =  NucleiSpotsConnection.NucleiSpotsConnection(spots_tracked, nuclei_tracked)
-
-        tifffile.imwrite(str(parallel_folder) + "/false_2colors.tiff", nuc_active.nuclei_active3c.astype("uint16"))
+        nuclei_tracked    =  SparseSpots.open_matrix(analysis_folder, 'nuclei_tracked')
+        spots_tracked     =  SpotsConnection.SpotsConnection(nuclei_tracked, np.sign(spots_3D.spots_vol), max_dist, "map").spots_tracked
+        spts_index        =  SpotsPixelIndex.SpotsPixelIndex(spots_tracked)                                         # sparse index of the pixels of each spot, shared by the following steps
+
+        if memory_budget is None:
+            nuc_active       =  NucleiSpotsConnection.NucleiSpotsConnection(spots_tracked, nuclei_tracked, spts_index)
+            n_active_vector  =  nuc_active.n_active_vector
+            tifffile.imwrite(str(parallel_folder) + "/false_2colors.tiff", nuc_active.nuclei_active3c.astype("uint16"))
+        else:
+            n_frames         =  TimeChunks.chunk_frames(nuclei_tracked[0].size * MemoryPlanner.ACTIVE3C_PIX_BYTES, memory_budget)
+            n_active_vector  =  np.zeros(nuclei_tracked.shape[0])
+            active3c_file    =  tifffile.memmap(str(parallel_folder) + "/false_2colors.tiff", shape=nuclei_tracked.shape + (3,), dtype="uint16")       # same file of 'imwrite', filled window by window
+            for t0, t1 in TimeChunks.time_chunks(nuclei_tracked.shape[0], n_frames):
+                nuc_active              =  NucleiSpotsConnection.NucleiSpotsConnection(spots_tracked, nuclei_tracked, spts_index, [t0, t1])
+                n_active_vector[t0:t1]  =  nuc_active.n_active_vector
+                active3c_file[t0:t1]    =  nuc_active.nuclei_active3c
+            active3c_file.flush()
+            del active3c_file, nuc_active
         np.save(parallel_folder + '/spots_3D_tzxy.npy', spots_3D.spots_tzxy.astype("uint16"))
-        np.save(parallel_folder + '/spots_3D_vol.npy', spots_3D.spots_vol.astype("uint16"))
         np.save(parallel_folder + '/spots_3D_coords.npy', spots_3D.spots_coords.astype("uint16"))
-        np.save(parallel_folder + '/spots_3D_ints.npy', spots_3D.spots_ints.astype("uint16"))
-        np.save(parallel_folder + '/spots_tracked.npy', spots_tracked.astype("uint16"))
-
-        idx          =  np.unique(spots_tracked)[1:]
-        av_in_spots  =  np.zeros((idx.size, spots_3D.spots_coords[-1, 0]))
-        i            =  0
-        for k in idx:
-            av_in_spots[i, :]  =   ((spots_tracked == k) * spots_3D.spots_ints).sum(2).sum(1)
-            i                  +=  1
-
-        ctrs  =  np.zeros((idx.size, spots_tracked.shape[0], 2))
-        i     =  0
-        for k in idx:
-            aa  =  (spots_tracked == k).astype(int)
-            for t in range(spots_tracked.shape[0]):
-                if aa[t, :, :].sum():
-                    aa_rgp         =  regionprops(aa[t, :, :])
-                    ctrs[i, t, :]  =  aa_rgp[0]['Centroid'][0], aa_rgp[0]['Centroid'][1]
-            i  +=  1
+        spots_mtxs  =  {"spots_tracked": spots_tracked.astype("uint16"), "spots_3D_ints": spots_3D.spots_ints.astype("uint16"), "spots_3D_vol": spots_3D.spots_vol.astype("uint16")}
+        SparseSpots.save_sparse(parallel_folder + '/' + SparseSpots.SPARSE_FNAME, spots_mtxs)
+        if dense_export:                                                                                            # dense matrices, as read by SegmentTrack
+            for name, mtx in spots_mtxs.items():
+                np.save(parallel_folder + '/' + name + '.npy', mtx)
+        del spots_mtxs
+
+        idx                   =  spts_index.spts_idxs
+        spots_ints            =  spots_3D.spots_ints.reshape(spots_3D.spots_ints.shape[0], -1)
+        pix_rows              =  spts_index.pixels_rows()                                                                            # all the spots at once: pixels grouped by (spot, frame) with a single bincount
+        t_coords, pix_coords  =  spts_index.t_coords, spts_index.pix_coords
+        n_cols                =  spots_3D.spots_coords[-1, 0]
+        av_in_spots           =  np.bincount(pix_rows * n_cols + t_coords, weights=spots_ints[t_coords, pix_coords], minlength=idx.size * n_cols).reshape(idx.size, n_cols)
+
+        steps                 =  spots_tracked.shape[0]
+        groups                =  pix_rows * steps + t_coords
+        x_coords, y_coords    =  np.divmod(pix_coords, spots_tracked.shape[2])
+        t_npix                =  np.bincount(groups, minlength=idx.size * steps)
+        t_on                  =  t_npix > 0
+        ctrs                  =  np.zeros((idx.size * steps, 2))
+        ctrs[t_on, 0]         =  np.bincount(groups, weights=x_coords, minlength=idx.size * steps)[t_on] / t_npix[t_on]            # centroid of each spot in each frame it is present
+        ctrs[t_on, 1]         =  np.bincount(groups, weights=y_coords, minlength=idx.size * steps)[t_on] / t_npix[t_on]
+        ctrs                  =  ctrs.reshape(idx.size, steps, 2)
 
         book    =  xlsxwriter.Workbook(parallel_folder + '/journal.xlsx')                                                                  # write results
         sheet1  =  book.add_worksheet("Sheet1")
@@ -86,14 +107,14 @@ class FilteredSpotsSaver:
         sheet1.write(0, 5, "Frame")
         sheet1.write(0, 6, "Active Nuc")
 
-        for t in range(nuc_active.n_active_vector.size):
+        for t in range(n_active_vector.size):
             sheet1.write(t + 1, 4, (time_zero + t) * time_step_value)
             sheet1.write(t + 1, 5, t)
             sheet1.write(3 + int(ctrs.shape[1]) + t, 4, (time_zero + t) * time_step_value)
             sheet1.write(3 + int(ctrs.shape[1]) + t, 5, t)
             sheet1.write(5 + 2 * int(ctrs.shape[1]) + t, 4, (time_zero + t) * time_step_value)
             sheet1.write(5 + 2 * int(ctrs.shape[1]) + t, 5, t)
-            sheet1.write(t + 1, 6, nuc_active.n_active_vector[t])
+            sheet1.write(t + 1, 6, n_active_vector[t])
 
         sheet1.write(1, 0, "Detection Algorithm")
         sheet1.write(2, 0, "Detection Parameter")
@@ -169,11 +190,12 @@ class FilteredSpotsSaver:
                     sheet2.write(t + 5 + 2 * int(ctrs.shape[1]), i + 7, ctrs[i + 240, t, 1])
         book.close()
 
-        x_vv  =  np.arange(nuc_active.n_active_vector.size)
-        plt   =  pg.plot()
-        plt.plot(x_vv, nuc_active.n_active_vector, pen='r', title='Number of Active Nuclei')
+        if show_plot:                                                                                                                       # no plot in batch runs
+            x_vv  =  np.arange(n_active_vector.size)
+            plt   =  pg.plot()
+            plt.plot(x_vv, n_active_vector, pen='r', title='Number of Active Nuclei')
 
-        WriteSptsIntsDividedByBkg.WriteSptsIntsDividedByBkg(parallel_folder, green4D, spots_3D, spots_tracked)
+        WriteSptsIntsDividedByBkg.WriteSptsIntsDividedByBkg(parallel_folder, green4D, spots_3D, spots_tracked, workers)
 
         filetxt  =  open(parallel_folder + '/filterInfo.txt', "w")
         filetxt.write("solidity_thr_value:  " + str(solidity_thr_value)  + "\n")
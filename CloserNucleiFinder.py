@@ -6,9 +6,16 @@ returns the label value of the closest object.
 To do that, it starts from a square centred in point and with a side of 1.
 If the maximum in the square is zero, the side is increased and the maximum
 is searched into a broader square. The side is kept smaller than 5.
+
+CloserNucleiMap gives the same result for all the pixels of a frame at once:
+the chessboard distance transform of the nuclei gives the side of the first
+non empty square of each pixel, and the maximum of the squares of that side
+is read from successive 3x3 dilations of the nuclei, so that each point is
+then just looked up.
 """
 
 import numpy as np
+from scipy.ndimage import distance_transform_cdt, maximum_filter
 
 
 class CloserNucleiFinder:
@@ -23,3 +30,21 @@ class CloserNucleiFinder:
             side   +=  1
 
         self.mx_pt  =  mx_pt
+
+
+class CloserNucleiMap:
+    """Label of the closer nucleus for each pixel of a frame, same result as CloserNucleiFinder."""
+    def __init__(self, nuclei_lbl, spt_nuc_maxdist):
+
+        mx_map    =  np.zeros_like(nuclei_lbl)
+        side_max  =  int(np.ceil(spt_nuc_maxdist)) - 1                                          # last side tested by CloserNucleiFinder (side < spt_nuc_maxdist)
+
+        if nuclei_lbl.any() and side_max >= 1:
+            side_map  =  np.maximum(distance_transform_cdt(nuclei_lbl == 0, metric="chessboard"), 1)      # side of the first square reaching a nucleus (the search starts with side 1)
+            dil_nucs  =  nuclei_lbl
+            for side in range(1, side_max + 1):
+                dil_nucs           =  maximum_filter(dil_nucs, size=3, mode="constant", cval=0)  # maximum in the square of side 'side' around each pixel
+                side_pxls          =  side_map == side
+                mx_map[side_pxls]  =  dil_nucs[side_pxls]
+
+        self.mx_map  =  mx_map
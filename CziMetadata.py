@@ -0,0 +1,89 @@
+"""This function reads the metadata of a .czi file.
+
+Dimensions, pixel type, channel layout, time stamps and pixel sizes are read in
+a single opening of the file, the xml metadata with a real xml parser. The
+result is kept as a small json record in the cache folder of the raw data,
+keyed by path, size and modification time of the file, so that loader, saver
+and batch runs read it again without touching the .czi file.
+"""
+
+
+import os
+import json
+import hashlib
+from xml.etree import ElementTree
+import numpy as np
+from czifile import CziFile
+
+import RawDataCache
+
+
+def record_fname(fname):
+    """Path of the metadata record of a file."""
+    file_key  =  json.dumps([os.path.abspath(fname), os.path.getsize(fname), os.path.getmtime(fname)])
+    return os.path.join(RawDataCache.CACHE_DIR, "metadata", hashlib.blake2b(file_key.encode(), digest_size=16).hexdigest() + ".json")
+
+
+def scaling_value(xml_root, axis):
+    """Pixel size along an axis in meters, from a 'ScalingX' like tag or from the 'Distance' items."""
+    value  =  xml_root.findtext(".//Scaling" + axis)
+    if value is None:
+        for distance in xml_root.iter("Distance"):
+            if distance.get("Id") == axis:
+                value  =  distance.findtext("Value")
+                break
+    return float(value)
+
+
+class CziMetadata:
+    """Metadata of a .czi file, from its record if already read."""
+    def __init__(self, fname):
+
+        record_path  =  record_fname(str(fname))
+        try:
+            with open(record_path) as record_file:
+                record  =  json.load(record_file)
+        except (OSError, ValueError):                                               # never read or broken record
+            record  =  None
+
+        if record is None:
+            with CziFile(str(fname)) as czi:                                        # single opening for all the metadata
+                dims        =  dict(zip(czi.axes, czi.shape))
+                xml_root    =  ElementTree.fromstring(czi.metadata())
+                timestamps  =  None
+                for attachment in czi.attachments():
+                    if attachment.attachment_entry.name == 'TimeStamps':
+                        timestamps  =  np.asarray(attachment.data()).tolist()
+                        break
+
+                record  =  {"time_steps": dims.get("T", 1), "z_steps": dims.get("Z", 1), "xlen": dims["Y"], "ylen": dims["X"], "n_channels": dims.get("C", 1),
+                            "dtype": czi.dtype.str, "nbytes": int(np.prod(czi.shape)) * czi.dtype.itemsize,
+                            "channel_names": [channel.get("Name") for channel in xml_root.iter("Channel") if channel.get("Name") is not None][:dims.get("C", 1)],
+                            "timestamps": timestamps,
+                            "pix_size": np.round(scaling_value(xml_root, "X") * 1000000, decimals=4),
+                            "pix_size_Z": np.round(scaling_value(xml_root, "Z") * 1000000, decimals=4)}
+
+            try:
+                os.makedirs(os.path.dirname(record_path), exist_ok=True)
+                with open(record_path, "w") as record_file:
+                    json.dump(record, record_file)
+            except OSError:                                                         # no cache folder: the record is just not reused
+                pass
+
+        self.time_steps     =  record["time_steps"]
+        self.z_steps        =  record["z_steps"]
+        self.xlen           =  record["xlen"]
+        self.ylen           =  record["ylen"]
+        self.n_channels     =  record["n_channels"]
+        self.channel_names  =  record["channel_names"]
+        self.dtype          =  np.dtype(record["dtype"])
+        self.nbytes         =  record["nbytes"]                                     # memory taken by the decoded file
+        self.timestamps     =  record["timestamps"]
+        self.pix_size       =  record["pix_size"]
+        self.pix_size_Z     =  record["pix_size_Z"]
+
+    def time_step_value(self):
+        """Time step of the file, from its time stamps."""
+        if self.timestamps is None:
+            raise ValueError('TimeStamps not found')
+        return np.round(self.timestamps[1] - self.timestamps[0], 2)
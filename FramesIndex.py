@@ -0,0 +1,57 @@
+"""This function manages the fingerprints of the frames of the red channel.
+
+The frames of the analysis are found in the raw movie by matching the two
+sample frames saved in 'im_red_smpl.npy'. Instead of subtracting the samples to
+the whole red movie, each frame is given a small fingerprint (a hash of its
+values) computed while loading, and samples are found comparing fingerprints.
+The fingerprints are saved in the analysis folder together with a key made by
+the raw files (paths, sizes, modification times), the channels and the crop, so
+that the next loads of the same analysis can skip the red channel pass.
+"""
+
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def frame_fingerprint(frame):
+    """Fingerprint of a frame: hash of its dtype, shape and values."""
+    frame  =  np.ascontiguousarray(frame)
+    hsh    =  hashlib.blake2b(digest_size=16)
+    hsh.update((frame.dtype.str + str(frame.shape)).encode())
+    hsh.update(frame.data)
+    return hsh.hexdigest()
+
+
+class FramesIndex:
+    """Fingerprints of the frames of the red channel, from the analysis folder if already saved for the same raw files."""
+    def __init__(self, foldername, fnames, nucs_spts_ch, crop_vect):
+
+        self.fname         =  foldername + '/red_frames_index.npz'
+        self.key           =  json.dumps([[[os.path.abspath(fname), os.path.getsize(fname), os.path.getmtime(fname)] for fname in sorted(fnames)], np.asarray(nucs_spts_ch).tolist(), None if crop_vect is None else np.asarray(crop_vect).tolist()])
+        self.fingerprints  =  None
+        self.dtype         =  None
+
+        if os.path.isfile(self.fname):
+            with np.load(self.fname) as saved:
+                if str(saved["key"]) == self.key:                                  # raw files changed since the index was saved: index is not valid
+                    self.fingerprints  =  saved["fingerprints"]
+                    self.dtype         =  np.dtype(str(saved["dtype"]))
+
+    def save(self, fingerprints, dtype):
+        """Store the fingerprints of the red frames and save them in the analysis folder."""
+        self.fingerprints  =  np.asarray(fingerprints)
+        self.dtype         =  np.dtype(dtype)
+        try:
+            np.savez(self.fname, fingerprints=self.fingerprints, dtype=self.dtype.str, key=self.key)
+        except OSError:                                                             # read only analysis folder: the index is just not reused
+            pass
+
+    def find(self, frame):
+        """Index of the first red frame equal to the given one."""
+        frame_cast  =  frame.astype(self.dtype)
+        if not np.array_equal(frame_cast, frame):                                   # values not representable in the dtype of the movie: no frame can be equal
+            raise IndexError("frame not found in the raw data")
+        return np.where(self.fingerprints == frame_fingerprint(frame_cast))[0][0]
@@ -0,0 +1,86 @@
+"""This function shares the unchanged files of an analysis with its parallel folders.
+
+Nuclei, crop, sample frames and channels of an analysis are the same in every
+'_SpotsFiltered' folder made from it. Instead of copying them, they can be
+reflinked (copy-on-write clone, on filesystems supporting it), hard linked, or
+listed in a manifest of the parallel folder pointing to the file of the source
+folder. The function 'resolve' gives the path of a file of a folder wherever
+it really is, so that loaders read linked and copied folders the same way.
+"""
+
+
+import os
+import json
+import shutil
+
+try:
+    import fcntl
+except ImportError:                     # Windows: no reflinks
+    fcntl  =  None
+
+
+MANIFEST_FNAME  =  "linked_files.json"
+LINK_MODES      =  ["copy", "link", "manifest"]
+FICLONE         =  0x40049409           # ioctl cloning a whole file (Linux: Btrfs, XFS, ...)
+
+
+def manifest(folder):
+    """Files of a folder listed in its manifest, with their paths relative to the folder."""
+    if not os.path.isfile(folder + '/' + MANIFEST_FNAME):
+        return {}
+    with open(folder + '/' + MANIFEST_FNAME) as f:
+        return json.load(f)
+
+
+def resolve(folder, fname):
+    """Path of a file of a folder: the file itself if present, the file it points to in the manifest otherwise."""
+    path  =  folder + '/' + fname
+    if os.path.exists(path):
+        return path
+    linked  =  manifest(folder).get(fname)
+    return os.path.normpath(os.path.join(folder, linked)) if linked is not None else path
+
+
+def reflink(src, dst):
+    """Clone a file sharing its blocks on disk, False if the filesystem does not support it."""
+    if fcntl is None:
+        return False
+    try:
+        with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+
+def hard_link(src, dst):
+    """Hard link a file, False if not possible (other device, filesystem without links)."""
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+def link_files(src_folder, dst_folder, fnames, link_mode="copy"):
+    """Give the files of a folder to another one: copies, links (or a manifest entry when no link is possible) or manifest entries."""
+    if link_mode not in LINK_MODES:
+        raise ValueError("link mode must be one of " + ", ".join(LINK_MODES) + ", not '" + str(link_mode) + "'")
+
+    linked  =  {}
+    for fname in fnames:
+        src  =  resolve(src_folder, fname)                                          # the real file, also when the source folder is linked itself
+        dst  =  dst_folder + '/' + fname
+        if link_mode == "copy":
+            shutil.copyfile(src, dst)
+        elif link_mode == "manifest" or not (reflink(src, dst) or hard_link(src, dst)):
+            try:
+                linked[fname]  =  os.path.relpath(src, dst_folder)                  # relative: both folders can be moved together
+            except ValueError:                                                      # Windows, different drives
+                linked[fname]  =  os.path.abspath(src)
+
+    if linked:
+        with open(dst_folder + '/' + MANIFEST_FNAME, "w") as f:
+            json.dump(linked, f, indent=2)
@@ -3,42 +3,80 @@
 Given the filename of a .lsm file, this function gives as output the matrices
 of the red and green channels maximum intensity projected plus the green channel
 as it is. Inputs are the file-name and the channel number for nuclei and spots.
+The file is read subblock by subblock: subblocks of each (channel, time) couple
+are decoded by a pool of threads and written straight in the destination
+matrices, so that the green stack and both projections are made in a single
+pass and the channels not needed are never decoded. Optionally, only a crop
+rectangle, a window of frames and one of the two channels are loaded, and
+subblocks outside them are not decoded at all.
 """
 
 
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import czifile
+from czifile import CziFile
 
 
 class LoadCzi5D:
     """Only class, does all the job."""
-    def __init__(self, fname, nucs_spts_ch):
+    def __init__(self, fname, nucs_spts_ch, max_workers=None, crop=None, t_lims=None, load_red=True, load_green=True):
 
-        file_array  =  np.squeeze(czifile.imread(fname))
+        with CziFile(str(fname)) as czi:
+            axes, start, shape  =  czi.axes, czi.start, czi.shape
+            c_ax, z_ax          =  axes.index("C"), axes.index("Z")
+            y_ax, x_ax          =  axes.index("Y"), axes.index("X")
+            t_ax                =  axes.find("T")                                                   # -1 if the file has no time axis
+            steps               =  shape[t_ax] if t_ax >= 0 else 1
 
-        if len(file_array.shape)  == 5:                                                             # case you have more than a time frame
-            c, steps, z, x_len, y_len  =  file_array.shape
+            t0, t1          =  t_lims if t_lims is not None else (0, steps)                         # frame window and crop rectangle (rows, cols of the frames): only the subblocks
+            y0, x0, y1, x1  =  crop if crop is not None else (0, 0, shape[y_ax], shape[x_ax])      # overlapping them are decoded
+            y1, x1          =  min(y1, shape[y_ax]), min(x1, shape[x_ax])
 
-            red_mtx    =  np.zeros((steps, x_len, y_len), dtype=np.int32)
-            green_mtx  =  np.zeros((steps, x_len, y_len), dtype=np.int32)
+            red_mtx    =  np.zeros((t1 - t0, y1 - y0, x1 - x0), dtype=czi.dtype) if load_red else None
+            green_mtx  =  np.zeros((t1 - t0, y1 - y0, x1 - x0), dtype=czi.dtype) if load_green else None
+            green4D    =  np.zeros((t1 - t0, shape[z_ax], y1 - y0, x1 - x0), dtype=czi.dtype) if load_green else None
 
-            for t in range(steps):                                                                  # maximum intensity projection
-                for x in range(x_len):
-                    red_mtx[t, x, :]    =  file_array[nucs_spts_ch[0], t, :, x, :].max(0)
-                    green_mtx[t, x, :]  =  file_array[nucs_spts_ch[1], t, :, x, :].max(0)
-            self.green4D  =  file_array[nucs_spts_ch[1], :, :, :, :]
+            tasks  =  {}                                                                            # subblocks of each (channel, time) couple, only for the nuclei and spots channels
+            for entry in czi.filtered_subblock_directory:
+                c   =  entry.start[c_ax] - start[c_ax]
+                t   =  entry.start[t_ax] - start[t_ax] if t_ax >= 0 else 0
+                ey  =  entry.start[y_ax] - start[y_ax]
+                ex  =  entry.start[x_ax] - start[x_ax]
+                if ((c == nucs_spts_ch[0] and load_red) or (c == nucs_spts_ch[1] and load_green)) and t0 <= t < t1 and ey < y1 and ey + entry.shape[y_ax] > y0 and ex < x1 and ex + entry.shape[x_ax] > x0:
+                    tasks.setdefault((c, t - t0), []).append(entry)
 
-        else:                                                                                       # case you have just one time frame
-            c, z, x_len, y_len  =  file_array.shape
+            def load_subblocks(task):
+                """Decode the subblocks of a (channel, time) couple; red is projected on the fly, green is stored and then projected."""
+                (c, t), entries  =  task
+                for entry in entries:
+                    tile      =  entry.data_segment().data(resize=True, order=0)
+                    tile      =  tile.reshape(tile.shape[z_ax], tile.shape[y_ax], tile.shape[x_ax])          # all the other axes of a subblock have size one
+                    z0        =  entry.start[z_ax] - start[z_ax]
+                    ty0       =  entry.start[y_ax] - start[y_ax]
+                    tx0       =  entry.start[x_ax] - start[x_ax]
+                    ry0, ry1  =  max(ty0, y0), min(ty0 + tile.shape[1], y1)                                  # part of the tile inside the crop
+                    rx0, rx1  =  max(tx0, x0), min(tx0 + tile.shape[2], x1)
+                    tile      =  tile[:, ry0 - ty0:ry1 - ty0, rx0 - tx0:rx1 - tx0]
+                    if c == nucs_spts_ch[1] and load_green:
+                        green4D[t, z0:z0 + tile.shape[0], ry0 - y0:ry1 - y0, rx0 - x0:rx1 - x0]  =  tile
+                    else:
+                        np.maximum(red_mtx[t, ry0 - y0:ry1 - y0, rx0 - x0:rx1 - x0], tile.max(0), out=red_mtx[t, ry0 - y0:ry1 - y0, rx0 - x0:rx1 - x0])     # this task is the only one writing in this frame
+                if c == nucs_spts_ch[1] and load_green:
+                    green4D[t].max(axis=0, out=green_mtx[t])
 
-            red_mtx    =  np.zeros((x_len, y_len))
-            green_mtx  =  np.zeros((x_len, y_len))
+            czi._fh.lock  =  True                                                                   # file handle shared by the threads, as czifile does in 'asarray'
+            with ThreadPoolExecutor(max_workers or max(os.cpu_count() // 2, 1)) as executor:
+                list(executor.map(load_subblocks, tasks.items()))                                   # consume the results to raise decoding errors
+            czi._fh.lock  =  None
 
-            for x in range(x_len):                                                                  # maximum intensity projection
-                red_mtx[x, :]    =  file_array[nucs_spts_ch[0], :, x, :].max(0)
-                green_mtx[x, :]  =  file_array[nucs_spts_ch[1], :, x, :].max(0)
+        if t_ax >= 0 and steps > 1:                                                                 # case you have more than a time frame
+            self.green4D  =  green4D
 
-            self.green4D    =  file_array[nucs_spts_ch[1], :, :, :]
+        else:                                                                                       # case you have just one time frame
+            red_mtx       =  red_mtx[0] if load_red else None
+            green_mtx     =  green_mtx[0] if load_green else None
+            self.green4D  =  green4D[0] if load_green else None
 
         self.red_mtx    =  red_mtx
         self.green_mtx  =  green_mtx
@@ -0,0 +1,125 @@
+"""This function loads .tif and .lsm files.
+
+Same outputs of 'LoadCzi5D' (red and green maximum intensity projections plus
+the green channel as it is, in the orientation of the file) for tiff files
+read with tifffile. Uncompressed stacks are memory mapped and compressed ones
+are read through zarr when available, so that only the frames, the channels
+and the crop needed are read from disk, frame by frame, and never the whole
+file. Metadata (sizes, pixel sizes, time step) come from the ImageJ or LSM
+tags.
+"""
+
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tifffile
+
+try:
+    import zarr
+except ImportError:                                             # zarr is optional: compressed tiff are then decoded in memory
+    zarr = None
+
+
+def tiff_array(fname):
+    """Lazy array of the first series of a tiff file, with its axes: memory map if possible, zarr or in memory otherwise."""
+    with tifffile.TiffFile(str(fname)) as tif:
+        axes  =  tif.series[0].axes
+    try:
+        return tifffile.memmap(str(fname), mode="r"), axes                              # uncompressed and contiguous: zero copy
+    except ValueError:
+        if zarr is not None:
+            return zarr.open(tifffile.imread(str(fname), aszarr=True), mode="r"), axes
+        return tifffile.imread(str(fname)), axes
+
+
+class TiffMetadata:
+    """Metadata of a tiff file, same attributes of 'CziMetadata'."""
+    def __init__(self, fname):
+
+        with tifffile.TiffFile(str(fname)) as tif:
+            series      =  tif.series[0]
+            dims        =  dict(zip(series.axes, series.shape))
+            pix_size    =  None
+            pix_size_Z  =  None
+            timestamps  =  None
+            if tif.is_lsm:
+                lsm_info    =  tif.lsm_metadata
+                pix_size    =  np.round(lsm_info["VoxelSizeX"] * 1000000, decimals=4)
+                pix_size_Z  =  np.round(lsm_info["VoxelSizeZ"] * 1000000, decimals=4)
+                if lsm_info.get("TimeStamps") is not None and len(lsm_info["TimeStamps"]) > 1:
+                    timestamps  =  np.asarray(lsm_info["TimeStamps"]).tolist()
+            elif tif.is_imagej:
+                ij_info     =  tif.imagej_metadata
+                x_res       =  tif.pages[0].tags["XResolution"].value                    # pixels per unit
+                pix_size    =  np.round(x_res[1] / x_res[0], decimals=4)
+                pix_size_Z  =  ij_info.get("spacing")
+                if ij_info.get("finterval") is not None:
+                    timestamps  =  [0, ij_info["finterval"]]
+
+            self.time_steps     =  dims.get("T", 1)
+            self.z_steps        =  dims.get("Z", 1)
+            self.xlen           =  dims["Y"]
+            self.ylen           =  dims["X"]
+            self.n_channels     =  dims.get("C", 1)
+            self.channel_names  =  []
+            self.dtype          =  series.dtype
+            self.nbytes         =  int(np.prod(series.shape)) * series.dtype.itemsize
+            self.timestamps     =  timestamps
+            self.pix_size       =  pix_size
+            self.pix_size_Z     =  pix_size_Z
+
+    def time_step_value(self):
+        """Time step of the file, from its time stamps."""
+        if self.timestamps is None:
+            raise ValueError('TimeStamps not found')
+        return np.round(self.timestamps[1] - self.timestamps[0], 2)
+
+
+class LoadTiff5D:
+    """Only class, does all the job."""
+    def __init__(self, fname, nucs_spts_ch, max_workers=None, crop=None, t_lims=None, load_red=True, load_green=True):
+
+        file_array, axes  =  tiff_array(fname)
+        dims              =  dict(zip(axes, file_array.shape))
+        steps             =  dims.get("T", 1)
+        z_steps           =  dims.get("Z", 1)
+
+        t0, t1          =  t_lims if t_lims is not None else (0, steps)                     # frame window and crop rectangle (rows, cols of the frames)
+        y0, x0, y1, x1  =  crop if crop is not None else (0, 0, dims["Y"], dims["X"])
+        y1, x1          =  min(y1, dims["Y"]), min(x1, dims["X"])
+
+        red_mtx    =  np.zeros((t1 - t0, y1 - y0, x1 - x0), dtype=file_array.dtype) if load_red else None
+        green_mtx  =  np.zeros((t1 - t0, y1 - y0, x1 - x0), dtype=file_array.dtype) if load_green else None
+        green4D    =  np.zeros((t1 - t0, z_steps, y1 - y0, x1 - x0), dtype=file_array.dtype) if load_green else None
+
+        def read_stack(c, t):
+            """Z stack of a channel in a frame inside the crop, as (z, y, x): only this part is read from disk."""
+            idx  =  tuple({"T": t, "C": c, "Z": slice(None), "Y": slice(y0, y1), "X": slice(x0, x1)}.get(ax, 0) for ax in axes)     # other axes (samples...) have size one
+            stack_axes  =  [ax for ax in axes if ax in "ZYX"]
+            stack       =  np.asarray(file_array[idx])
+            if "Z" not in stack_axes:
+                stack, stack_axes  =  stack[np.newaxis], ["Z"] + stack_axes
+            return np.transpose(stack, [stack_axes.index(ax) for ax in "ZYX"])
+
+        def load_frame(t):
+            """Read and project a frame."""
+            if load_red:
+                red_mtx[t - t0]  =  read_stack(nucs_spts_ch[0], t).max(0)
+            if load_green:
+                green4D[t - t0]  =  read_stack(nucs_spts_ch[1], t)
+                green4D[t - t0].max(axis=0, out=green_mtx[t - t0])
+
+        with ThreadPoolExecutor(max_workers or max(os.cpu_count() // 2, 1)) as executor:
+            list(executor.map(load_frame, range(t0, t1)))                                   # consume the results to raise reading errors
+
+        if "T" in axes and steps > 1:                                                       # case you have more than a time frame
+            self.green4D  =  green4D
+
+        else:                                                                               # case you have just one time frame
+            red_mtx       =  red_mtx[0] if load_red else None
+            green_mtx     =  green_mtx[0] if load_green else None
+            self.green4D  =  green4D[0] if load_green else None
+
+        self.red_mtx    =  red_mtx
+        self.green_mtx  =  green_mtx
@@ -0,0 +1,97 @@
+"""This function estimates the memory needed by an analysis before loading it.
+
+Sizes and dtypes come only from the headers of the raw files (see RawReaders)
+and of the matrices of the analysis folder (.npy files opened as memory maps,
+or sparse columns, see SparseSpots), never read. From them the peak resident memory of loading, filtering and
+saving is predicted, both with everything in memory and in the out-of-core
+mode (raw movie on disk, false colored video built by windows of frames).
+The plan is the mode that fits the available memory: in memory if possible,
+out-of-core with the memory budget left otherwise, and a MemoryError with the
+estimates if not even the out-of-core mode fits.
+"""
+
+
+import os
+import multiprocessing
+import numpy as np
+
+import RawReaders
+import SparseSpots
+
+try:
+    import psutil
+except ImportError:                         # psutil is optional: memory is read from /proc/meminfo on Linux
+    psutil  =  None
+
+
+SAFETY_FRACTION     =  0.8                   # fraction of the available memory a plan can use
+ACTIVE3C_PIX_BYTES  =  48                    # memory of a pixel of the false colored video while it is built (int labels, float rgb, uint16 copy)
+
+
+def available_memory():
+    """Memory available for new processes (free plus reclaimable page cache) in bytes, None if it cannot be measured."""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:                         # not Linux
+        pass
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    return None
+
+
+def gb(n_bytes):
+    """Bytes in GB, rounded for messages."""
+    return str(np.round(n_bytes / 2 ** 30, 2)) + " GB"
+
+
+class MemoryPlanner:
+    """Peak memory of loading, filtering and saving an analysis, from the headers of its files."""
+    def __init__(self, analysis_folder, fnames, processes=None):
+
+        headers                    =  [RawReaders.reader(fname)[0](fname) for fname in fnames]                      # raw files metadata, no decoding
+        spts_shape, spts_dtype     =  SparseSpots.matrix_header(analysis_folder, 'spots_tracked')                    # analysis matrices: frames and crop of the analysis
+        _, nucs_dtype              =  SparseSpots.matrix_header(analysis_folder, 'nuclei_tracked')
+        _, ints_dtype              =  SparseSpots.matrix_header(analysis_folder, 'spots_3D_ints')
+        _, vol_dtype               =  SparseSpots.matrix_header(analysis_folder, 'spots_3D_vol')
+        processes                  =  processes or multiprocessing.cpu_count()
+
+        steps, rows, cols  =  spts_shape
+        z_steps            =  headers[0].z_steps
+        raw_isz            =  headers[0].dtype.itemsize
+        frame_pix          =  rows * cols
+        pix_3D             =  steps * frame_pix                                                                        # pixels of a (t, x, y) matrix of the analysis
+
+        green4D_bytes  =  pix_3D * z_steps * raw_isz
+        mips_bytes     =  2 * pix_3D * raw_isz                                                                         # green and red projections
+        first_pass     =  0 if os.path.isfile(analysis_folder + '/red_frames_index.npz') else sum(header.time_steps for header in headers) * frame_pix * raw_isz      # red channel of all the frames, when the frames index is not saved yet
+        decode_bytes   =  min(processes, len(headers)) * max(header.time_steps for header in headers) * (z_steps + 2) * frame_pix * raw_isz      # decoded files held by the loading threads
+        session_3D     =  pix_3D * (2 * spts_dtype.itemsize + nucs_dtype.itemsize + 2 * 2)                            # tracked spots (and their shared copy), nuclei, spots to show and to remove
+        filter_tmp     =  pix_3D * 3 * spts_dtype.itemsize                                                             # masks and products of the filters
+        save_3D        =  pix_3D * (2 * ints_dtype.itemsize + 2 * vol_dtype.itemsize + 2 * spts_dtype.itemsize + nucs_dtype.itemsize)             # filtered spots, their shared copies, new tracked spots and nuclei
+        sat_bytes      =  processes * 2 * (z_steps + 1) * (rows + 1) * (cols + 1) * 8                                  # integral images of the background workers
+
+        self.load_peak    =  green4D_bytes + mips_bytes + first_pass + decode_bytes + green4D_bytes                   # green4D is copied once in shared memory
+        self.filter_peak  =  green4D_bytes + mips_bytes + session_3D + filter_tmp
+        self.save_peak    =  green4D_bytes + mips_bytes + session_3D + save_3D + max(pix_3D * ACTIVE3C_PIX_BYTES, sat_bytes)
+        self.peak         =  max(self.load_peak, self.filter_peak, self.save_peak)
+
+        self.lean_fixed   =  first_pass + session_3D + max(filter_tmp, save_3D + sat_bytes)                          # out-of-core: only the matrices of the analysis stay in memory
+        self.lean_window  =  max((z_steps + 2) * frame_pix * raw_isz, frame_pix * ACTIVE3C_PIX_BYTES)                # smallest window: a single frame
+        self.lean_peak    =  self.lean_fixed + self.lean_window
+
+    def plan(self, available=None):
+        """Memory budget of the out-of-core mode, None if the analysis fits in memory; MemoryError if nothing fits."""
+        if available is None:
+            available  =  available_memory()
+        if available is None:                                                                                      # memory cannot be measured: loaded in memory as without planner
+            return None
+        usable  =  available * SAFETY_FRACTION
+
+        if self.peak <= usable:
+            return None
+        if self.lean_peak <= usable:
+            return usable - self.lean_fixed                                                                         # windows as big as the memory left allows
+        raise MemoryError("this analysis needs about " + gb(self.peak) + " in memory (" + gb(self.lean_peak) + " out-of-core), but only " + gb(available) + " are available: crop your data or free some memory")
@@ -3,197 +3,141 @@
 Taking .czi filenames as input, the output are the concatenated matrices of the
 maximum intensity projection of red and green channels plus the green channel in
 4D (because of 3D detection purpouses). Matrices are also flipped and rotate to
-have a visualization conform to ImageJ standards. In order to avoid to use 3D
-and 4D matrices for concatenation (cumbersome to handle) the matrices are
-always reshaped in a 1D vector, concatenated and reshaped at the end into
-a matrix shape.
+have a visualization conform to ImageJ standards. The metadata of each file are read
+first (see CziMetadata), so that the final matrices are allocated only once and
+each file is written in its own time slot, already in the ImageJ orientation
+(rotation plus flip is a swap of the last two axes). Files are decoded
+concurrently by a pool of threads, as many as the cores and the available
+memory allow; each thread writes its file in its own slot of the shared final
+matrices, so the natural order of the files is kept whatever the order they
+are decoded. A crop rectangle and a window of frames can be given, so that only
+the frames and tiles needed are decoded, and the red or the green channel can be
+skipped. Each file is read by the backend of its format (see RawReaders), so
+.czi, .tif and .lsm files are handled the same way. In the out-of-core mode
+the final matrices are .npy files memory mapped in a folder, and each file is
+decoded in windows of frames fitting a memory budget, so that the movie never
+needs to fit in memory.
 """
 
 
-# import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from czifile import CziFile
 from natsort import natsorted
 
-import LoadCzi5D
+import RawReaders
+import FramesIndex
+import TimeChunks
+import MemoryPlanner
 
 
 class MultiProcLoadCzi5D:
     """Multiprocesses the load multi czi function."""
-    def __init__(self, fnames, nucs_spts_ch):
-
-        # fnames        =  fnames_chs[0]
-        # nucs_spts_ch  =  fnames_chs[1]
+    def __init__(self, fnames, nucs_spts_ch, crop_vect=None, t_lims=None, load_red=True, load_green=True, out_folder=None, memory_budget=None, processes=None):
 
         fnames  =  natsorted(fnames, key=lambda y: y.lower())                           # natural order for file names
 
         if len(fnames) > 0:                                                             # it can be zero when used in multiprocessing
-            t_steps_done  =  False                                                      # flag for time steps reading
-            mt_buff       =  LoadCzi5D.LoadCzi5D(str(fnames[0]), nucs_spts_ch)          # read first .czi file
-
-            imarray_red    =  mt_buff.red_mtx                                           # separate its different channels
-            imarray_green  =  mt_buff.green_mtx
-            green4D        =  mt_buff.green4D
+            raw_data  =  MultiLoadCzi5D([fnames, nucs_spts_ch], crop_vect, t_lims, load_red, load_green, out_folder, memory_budget, processes)
 
-            if len(mt_buff.red_mtx.shape) == 2:                                         # store info about size: if a file has just one time frame, it will have one dimension less
-                time_steps           =  1
-                z_steps, xlen, ylen  =  green4D.shape
-            else:
-                time_steps, z_steps, xlen, ylen  =  green4D.shape
-                with CziFile(str(fnames[0])) as czi:
-                    for attachment in czi.attachments():
-                        if attachment.attachment_entry.name == 'TimeStamps':
-                            timestamps  =  attachment.data()
-                            break
-                    else:
-                        raise ValueError('TimeStamps not found')
-
-                time_step_value  =  np.round(timestamps[1] - timestamps[0], 2)    # time step value
-                t_steps_done     =  True                                          # prevent to read it again from other files (useless)
-
-            imarray_red    =  imarray_red.reshape(imarray_red.size)                     # reshape all the matrix we declare into a 1D vector
-            imarray_green  =  imarray_green.reshape(imarray_green.size)
-            green4D        =  green4D.reshape(green4D.size)
-
-            if len(fnames) > 1:
-                for s in range(1, len(fnames)):                                         # reading further files (if any)
-
-                    mt_buff  =  LoadCzi5D.LoadCzi5D(str(fnames[s]), nucs_spts_ch)
-                    if len(mt_buff.red_mtx.shape) == 2:                                 # store info about the matrix size
-                        t_steps_bff  =  1
-                    else:
-                        t_steps_bff  =  mt_buff.green4D.shape[0]
-
-                        if t_steps_done is False:                                       # read the time step value on the first file that has more than 1 time frame
-                            with CziFile(str(fnames[s])) as czi:
-                                for attachment in czi.attachments():
-                                    if attachment.attachment_entry.name == 'TimeStamps':
-                                        timestamps = attachment.data()
-                                        break
-                                else:
-                                    raise ValueError('TimeStamps not found')
-
-                            time_step_value  =  np.round(timestamps[1] - timestamps[0], 2)    # time step value
-                            t_steps_done     =  True                                          # prevent to read it again from other files (useless)
-
-                    imarray_red    =  np.append(imarray_red, mt_buff.red_mtx.reshape(mt_buff.red_mtx.size))                      # append new data to previous
-                    imarray_green  =  np.append(imarray_green, mt_buff.green_mtx.reshape(mt_buff.green_mtx.size))
-                    green4D        =  np.append(green4D, mt_buff.green4D.reshape(mt_buff.green4D.size))
-
-                    time_steps  +=  t_steps_bff
-
-            imarray_red    =  imarray_red.reshape((time_steps, xlen, ylen))                                                     # final reshape of the matrioces
-            imarray_green  =  imarray_green.reshape((time_steps, xlen, ylen))
-            green4D        =  green4D.reshape((time_steps, z_steps, xlen, ylen))
-            imarray_red    =  np.rot90(imarray_red, axes=(1, 2))[:, ::-1, :]                                                    # rotation to adapt to the imageJ format
-            imarray_green  =  np.rot90(imarray_green, axes=(1, 2))[:, ::-1, :]
-            green4D        =  np.rot90(green4D, axes=(2, 3))[:, :, ::-1, :]
-
-            a      =  CziFile(str(fnames[0]))                                                                                   # read info about pixel size
-            b      =  a.metadata()
-
-            start     =  b.find("ScalingX")
-            end       =  b[start + 9:].find("ScalingX")
-            pix_size  =  np.round(float(b[start + 9:start + 7 + end]) * 1000000, decimals=4)
-
-            start_Z     =  b.find("ScalingZ")
-            end_Z       =  b[start_Z + 9:].find("ScalingZ")
-            pix_size_Z  =  np.round(float(b[start_Z + 9:start_Z + 7 + end_Z]) * 1000000, decimals=4)
-
-            self.time_steps       =  time_steps
-            self.pix_size         =  pix_size
-            self.pix_size_Z       =  pix_size_Z
-            self.time_step_value  =  time_step_value
-            self.imarray_red      =  imarray_red
-            self.imarray_green    =  imarray_green
-            self.green4D          =  green4D
+            self.time_steps        =  raw_data.time_steps
+            self.pix_size          =  raw_data.pix_size
+            self.pix_size_Z        =  raw_data.pix_size_Z
+            self.time_step_value   =  raw_data.time_step_value
+            self.imarray_red       =  raw_data.imarray_red
+            self.imarray_green     =  raw_data.imarray_green
+            self.green4D           =  raw_data.green4D
+            self.red_fingerprints  =  raw_data.red_fingerprints
 
 
 class MultiLoadCzi5D:
     """Core of multi loading function"""
-    def __init__(self, fnames_chs):
+    def __init__(self, fnames_chs, crop_vect=None, t_lims=None, load_red=True, load_green=True, out_folder=None, memory_budget=None, processes=None):
 
         fnames        =  fnames_chs[0]
         nucs_spts_ch  =  fnames_chs[1]
 
         if len(fnames) > 0:                                                             # it can be zero when used in multiprocessing
-            t_steps_done  =  False                                                      # flag for time steps reading
-            mt_buff       =  LoadCzi5D.LoadCzi5D(str(fnames[0]), nucs_spts_ch)          # read first .czi file
-
-            imarray_red    =  mt_buff.red_mtx                                           # separate its different channels
-            imarray_green  =  mt_buff.green_mtx
-            green4D        =  mt_buff.green4D
-
-            if len(mt_buff.red_mtx.shape) == 2:                                         # store info about size: if a file has just one time frame, it will have one dimension less
-                time_steps           =  1
-                z_steps, xlen, ylen  =  green4D.shape
+            readers     =  [RawReaders.reader(fname) for fname in fnames]               # metadata and loader classes of the format of each file
+            headers     =  [readers[s][0](fname) for s, fname in enumerate(fnames)]     # metadata of each file, no decoding
+            t_edges     =  np.cumsum([0] + [header.time_steps for header in headers])
+            cores       =  processes or os.cpu_count()                                    # cores given to the loading (batch: shared among the concurrent embryos)
+            z_steps     =  headers[0].z_steps
+            xlen        =  headers[0].xlen
+            ylen        =  headers[0].ylen
+
+            if crop_vect is None:                                                       # crop and frame window in the ImageJ orientation and in the concatenated movie
+                crop_vect  =  [0, 0, ylen, xlen]
+            if t_lims is None:
+                t_lims  =  [0, int(t_edges[-1])]
+
+            time_steps  =  t_lims[1] - t_lims[0]
+            rows        =  min(crop_vect[2], ylen) - crop_vect[0]
+            cols        =  min(crop_vect[3], xlen) - crop_vect[1]
+            file_crop   =  [crop_vect[1], crop_vect[0], crop_vect[3], crop_vect[2]]        # same crop in the orientation of the file, rows and columns are swapped
+
+            def allocate(name, shape):
+                """Final matrix, in memory or (out-of-core) as a memory mapped .npy file filled window by window."""
+                if out_folder is None:
+                    return np.zeros(shape, dtype=headers[0].dtype)
+                return np.lib.format.open_memmap(os.path.join(out_folder, name + ".npy"), mode="w+", dtype=headers[0].dtype, shape=tuple(int(n) for n in shape))      # plain ints in the .npy header
+
+            imarray_red    =  allocate("imarray_red", (time_steps, rows, cols)) if load_red else None                           # final matrices, already in the ImageJ orientation
+            imarray_green  =  allocate("imarray_green", (time_steps, rows, cols)) if load_green else None
+            green4D        =  allocate("green4D", (time_steps, z_steps, rows, cols)) if load_green else None
+            red_prints     =  [None] * time_steps if load_red else None                                                         # fingerprints of the red frames, to find frames without arithmetic on the movie
+
+            files_t  =  [[max(t_lims[0], t_edges[s]), min(t_lims[1], t_edges[s + 1])] for s in range(len(fnames))]                 # frames of each file inside the window
+            files_s  =  [s for s in range(len(fnames)) if files_t[s][0] < files_t[s][1]]                                         # files outside the window are not read at all
+
+            if memory_budget is None:
+                free_mem   =  MemoryPlanner.available_memory()
+                n_threads  =  max(min(cores, len(files_s)), 1)
+                if free_mem is not None:                                                                                                # memory not measurable: one thread per core
+                    free_mem   -=  sum(mtx.nbytes for mtx in (imarray_red, imarray_green, green4D) if mtx is not None)                 # final matrices are not filled yet, their memory is still counted as available
+                    n_threads   =  int(max(min(n_threads, free_mem // max(header.nbytes for header in headers)), 1))                   # each thread holds a decoded file at a time
+                n_frames   =  time_steps                                                                                                # whole files
             else:
-                time_steps, z_steps, xlen, ylen  =  green4D.shape
-                with CziFile(str(fnames[0])) as czi:
-                    for attachment in czi.attachments():
-                        if attachment.attachment_entry.name == 'TimeStamps':
-                            timestamps  =  attachment.data()
-                            break
-                    else:
-                        raise ValueError('TimeStamps not found')
-
-                time_step_value  =  np.round(timestamps[1] - timestamps[0], 2)    # time step value
-                t_steps_done     =  True                                          # prevent to read it again from other files (useless)
-
-            imarray_red    =  imarray_red.reshape(imarray_red.size)                     # reshape all the matrix we declare into a 1D vector
-            imarray_green  =  imarray_green.reshape(imarray_green.size)
-            green4D        =  green4D.reshape(green4D.size)
-
-            if len(fnames) > 1:
-                for s in range(1, len(fnames)):                                         # reading further files (if any)
-
-                    mt_buff  =  LoadCzi5D.LoadCzi5D(str(fnames[s]), nucs_spts_ch)
-                    if len(mt_buff.red_mtx.shape) == 2:                                 # store info about the matrix size
-                        t_steps_bff  =  1
-                    else:
-                        t_steps_bff  =  mt_buff.green4D.shape[0]
-
-                        if t_steps_done is False:                                       # read the time step value on the first file that has more than 1 time frame
-                            with CziFile(str(fnames[s])) as czi:
-                                for attachment in czi.attachments():
-                                    if attachment.attachment_entry.name == 'TimeStamps':
-                                        timestamps = attachment.data()
-                                        break
-                                else:
-                                    raise ValueError('TimeStamps not found')
-
-                            time_step_value  =  np.round(timestamps[1] - timestamps[0], 2)    # time step value
-                            t_steps_done     =  True                                          # prevent to read it again from other files (useless)
-
-                    imarray_red    =  np.append(imarray_red, mt_buff.red_mtx.reshape(mt_buff.red_mtx.size))                      # append new data to previous
-                    imarray_green  =  np.append(imarray_green, mt_buff.green_mtx.reshape(mt_buff.green_mtx.size))
-                    green4D        =  np.append(green4D, mt_buff.green4D.reshape(mt_buff.green4D.size))
-
-                    time_steps  +=  t_steps_bff
-
-            imarray_red    =  imarray_red.reshape((time_steps, xlen, ylen))                                                     # final reshape of the matrioces
-            imarray_green  =  imarray_green.reshape((time_steps, xlen, ylen))
-            green4D        =  green4D.reshape((time_steps, z_steps, xlen, ylen))
-
-            imarray_red    =  np.rot90(imarray_red, axes=(1, 2))[:, ::-1, :]                                                    # rotation to adapt to the imageJ format
-            imarray_green  =  np.rot90(imarray_green, axes=(1, 2))[:, ::-1, :]
-            green4D        =  np.rot90(green4D, axes=(2, 3))[:, :, ::-1, :]
-
-            a      =  CziFile(str(fnames[0]))                                                                                   # read info about pixel size
-            b      =  a.metadata()
-
-            start     =  b.find("ScalingX")
-            end       =  b[start + 9:].find("ScalingX")
-            pix_size  =  np.round(float(b[start + 9:start + 7 + end]) * 1000000, decimals=4)
-
-            start_Z     =  b.find("ScalingZ")
-            end_Z       =  b[start_Z + 9:].find("ScalingZ")
-            pix_size_Z  =  np.round(float(b[start_Z + 9:start_Z + 7 + end_Z]) * 1000000, decimals=4)
-
-            self.time_steps       =  time_steps
-            self.pix_size         =  pix_size
-            self.pix_size_Z       =  pix_size_Z
-            self.time_step_value  =  time_step_value
-            self.imarray_red      =  imarray_red
-            self.imarray_green    =  imarray_green
-            self.green4D          =  green4D
+                frame_mem  =  (z_steps + 2) * rows * cols * headers[0].dtype.itemsize                                                   # green stack and projections of a frame
+                n_threads  =  int(max(min(cores, len(files_s), memory_budget // frame_mem), 1))                               # each thread holds a window of frames at a time
+                n_frames   =  TimeChunks.chunk_frames(n_threads * frame_mem, memory_budget)
+            n_decode  =  max(cores // n_threads, 1)                                                                             # decoding threads of each file, cores are not oversubscribed
+
+            def load_file(s):
+                """Decode the needed part of a file, window by window, and write it in its time slot."""
+                for w_t0, w_t1 in TimeChunks.time_chunks(files_t[s][1] - files_t[s][0], n_frames):
+                    f_t0, f_t1  =  files_t[s][0] + w_t0, files_t[s][0] + w_t1
+                    mt_buff     =  readers[s][1](str(fnames[s]), nucs_spts_ch, n_decode, file_crop, [f_t0 - t_edges[s], f_t1 - t_edges[s]], load_red, load_green)
+                    slot        =  slice(f_t0 - t_lims[0], f_t1 - t_lims[0])
+                    if load_red:
+                        imarray_red[slot]  =  mt_buff.red_mtx.swapaxes(-1, -2)                                                  # a file with just one time frame has one dimension less: it is broadcasted in its slot
+                        for t in range(slot.start, slot.stop):
+                            red_prints[t]  =  FramesIndex.frame_fingerprint(imarray_red[t])
+                    if load_green:
+                        imarray_green[slot]  =  mt_buff.green_mtx.swapaxes(-1, -2)
+                        green4D[slot]        =  mt_buff.green4D.swapaxes(-1, -2)
+
+            with ThreadPoolExecutor(n_threads) as executor:
+                list(executor.map(load_file, files_s))                                  # consume the results to raise decoding errors
+
+            for mtx in (imarray_red, imarray_green, green4D):
+                if isinstance(mtx, np.memmap):
+                    mtx.flush()
+
+            time_step_value  =  None
+            for header in headers:
+                if header.time_steps > 1:                                               # read the time step value on the first file that has more than 1 time frame
+                    time_step_value  =  header.time_step_value()
+                    break
+
+            pix_size    =  headers[0].pix_size                                          # info about pixel size
+            pix_size_Z  =  headers[0].pix_size_Z
+
+            self.time_steps        =  time_steps
+            self.pix_size          =  pix_size
+            self.pix_size_Z        =  pix_size_Z
+            self.time_step_value   =  time_step_value
+            self.imarray_red       =  imarray_red
+            self.imarray_green     =  imarray_green
+            self.green4D           =  green4D
+            self.red_fingerprints  =  red_prints
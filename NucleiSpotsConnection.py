@@ -1,29 +1,37 @@
-"""Given tracked spots and tracked nuclei, this function generates the false colored video."""
+"""Given tracked spots and tracked nuclei, this function generates the false colored video.
+
+A window of frames can be given, so that the video of a long movie is built
+window by window (out-of-core mode).
+"""
 
 import numpy as np
-from skimage.measure import label, regionprops_table
-from PyQt5 import QtWidgets
+from skimage.measure import label
+
+import SpotsPixelIndex
+import ServiceWidgets
 
 
 class NucleiSpotsConnection:
     """Only one clss, does all the job."""
-    def __init__(self, spots_tracked, nuclei_tracked):
+    def __init__(self, spots_tracked, nuclei_tracked, spts_index=None, t_lims=None):
+
+        if spts_index is None:
+            spts_index  =  SpotsPixelIndex.SpotsPixelIndex(spots_tracked)                                  # sparse index of the spots pixels (built here if not shared by the caller)
 
-        nuclei_active  =  np.sign(nuclei_tracked).astype(int)
-        idx            =  np.unique(spots_tracked)[1:]                                                             # list of all the values in the spots matrix. The zero, which is the first, is removed
+        t0, t1          =  t_lims if t_lims is not None else (0, nuclei_tracked.shape[0])
+        spots_tracked   =  spots_tracked[t0:t1]
+        nuclei_tracked  =  nuclei_tracked[t0:t1]
+        nuclei_active   =  np.sign(nuclei_tracked).astype(int)
+        activity        =  spts_index.activity_matrix()[:, t0:t1]                                          # spots x time activity matrix, rows follow the sorted labels of all the spots (zero excluded)
 
-        pbar  =  ProgressBar(total1=idx.size)
+        pbar  =  ServiceWidgets.progress_bar(total1=nuclei_tracked.shape[0])
         pbar.show()
 
-        i         =  0
-        rgp_spts  =  regionprops_table(spots_tracked.astype(np.int32), properties=["label", "coords"])   # dictionary with label and coordinate of each non zero pixel
-        for k in idx:
-            pbar.update_progressbar(i)
-            coord_idx  =  np.where(rgp_spts["label"] == k)[0][0]                    # search the dictionary location with the corresponding label, generally is k + 1, but like this is 100% sure
-            t_steps    =  np.unique(rgp_spts["coords"][coord_idx][:, 0])            # array with the t coordinate of each pixel of the spot tracked. np.unique to have only once the number of the frame in which the            i  +=  1
-            i         +=  1
-            for tt in t_steps:
-                nuclei_active[tt, :, :]  +=  (nuclei_tracked[tt, :, :] == k)
+        for tt in range(nuclei_tracked.shape[0]):
+            pbar.update_progressbar(tt)
+            lbls_tt  =  spts_index.spts_idxs[activity[:, tt] != 0]                                         # labels of the spots active in the frame
+            if lbls_tt.size > 0:
+                nuclei_active[tt, :, :]  +=  np.isin(nuclei_tracked[tt, :, :], lbls_tt)                     # nuclei with the same label of an active spot are active
 
         pbar.close()
 
@@ -43,26 +51,3 @@ class NucleiSpotsConnection:
         self.n_active_vector  =  n_active_vector
         self.popt             =  0
         self.perr             =  0
-
-
-class ProgressBar(QtWidgets.QWidget):
-    """Simple progress bar widget."""
-    def __init__(self, parent=None, total1=20):
-        super().__init__(parent)
-        self.name_line1  =  QtWidgets.QLineEdit()
-
-        self.progressbar1  =  QtWidgets.QProgressBar()
-        self.progressbar1.setMinimum(1)
-        self.progressbar1.setMaximum(total1)
-
-        main_layout  =  QtWidgets.QGridLayout()
-        main_layout.addWidget(self.progressbar1, 0, 0)
-
-        self.setLayout(main_layout)
-        self.setWindowTitle("Progress")
-        self.setGeometry(500, 300, 300, 50)
-
-    def update_progressbar(self, val1):
-        """Progressbar updater"""
-        self.progressbar1.setValue(val1)
-        QtWidgets.qApp.processEvents()
@@ -3,14 +3,21 @@
 
 import numpy as np
 from skimage.morphology import label
-from PyQt5 import QtWidgets
+
+import SpotsPixelIndex
+import ServiceWidgets
 
 
 class ParametersExtraction:
-    def __init__(self, raw_sp, sp_tr, sp_vol):
+    def __init__(self, raw_sp, sp_tr, sp_vol, spts_index=None):
+
+        if spts_index is None:
+            spts_index  =  SpotsPixelIndex.SpotsPixelIndex(sp_tr)      # sparse index of the spots pixels (built here if not shared by the caller)
 
-        idx   =  np.unique(sp_tr)[1:]                   # tags of all the tracked spots
-        pbar  =  ProgressBar(total1=idx.size)
+        idx          =  spts_index.spts_idxs            # tags of all the tracked spots
+        raw_sp_flat  =  raw_sp.reshape(raw_sp.shape[0], -1)
+        sp_vol_flat  =  sp_vol.reshape(sp_vol.shape[0], -1)
+        pbar         =  ServiceWidgets.progress_bar(total1=idx.size)
         pbar.show()
 
         numb_bursts      =  np.zeros(idx.shape)                         # initialize the number of bursts matrix
@@ -23,9 +30,10 @@ class ParametersExtraction:
 
         for k in range(idx.size):                                              # for each spot
             pbar.update_progressbar(k)
-            lls             =  ((sp_tr == idx[k]) * raw_sp).sum(2).sum(1)      # isolate a spot
-            sp_vol_k        =  ((sp_tr == idx[k]) * sp_vol).sum(2).sum(1)
-            lls_sgn         =  np.sign(lls)
+            t_crd, p_crd    =  spts_index.pixels(k)                                                         # pixels of the spot
+            lls             =  np.bincount(t_crd, weights=raw_sp_flat[t_crd, p_crd], minlength=raw_sp.shape[0])  # isolate a spot
+            sp_vol_k        =  np.bincount(t_crd, weights=sp_vol_flat[t_crd, p_crd], minlength=raw_sp.shape[0])
+            lls_sgn         =  np.sign(lls).astype(int)
             lls_lbl         =  label(lls_sgn)
             numb_bursts[k]  =  lls_lbl.max()
             lls_sil         =  np.abs(1 - np.sign(lls_lbl))
@@ -79,26 +87,3 @@ class ParametersExtraction:
         self.bursts_duration  =  bursts_duration
         self.idx              =  idx
         self.statistics_info  =  statistics_info
-
-
-class ProgressBar(QtWidgets.QWidget):
-    """Simple progressbar widget"""
-    def __init__(self, parent=None, total1=20):
-        super().__init__(parent)
-        self.name_line1  =  QtWidgets.QLineEdit()
-
-        self.progressbar1  =  QtWidgets.QProgressBar()
-        self.progressbar1.setMinimum(1)
-        self.progressbar1.setMaximum(total1)
-
-        main_layout  =  QtWidgets.QGridLayout()
-        main_layout.addWidget(self.progressbar1, 0, 0)
-
-        self.setLayout(main_layout)
-        self.setWindowTitle("Progress")
-        self.setGeometry(500, 300, 300, 50)
-
-    def update_progressbar(self, val1):
-        """progress bar updater"""
-        self.progressbar1.setValue(val1)
-        QtWidgets.qApp.processEvents()
@@ -0,0 +1,203 @@
+"""This function manages a local on-disk cache of the decoded raw data.
+
+Decoding the .czi files is the slowest part of opening an analysis folder.
+The cropped and frame-sliced matrices given by 'AnalysisLoader.RawData' are
+stored as .npy files in a cache folder, one entry per set of raw files
+(paths, sizes, modification times), channels, crop and sample frames. Entries
+are opened memory-mapped, so pages are read from disk only when used. The cache
+has a size cap: when a new entry does not fit, the least recently used entries
+are removed, but never the entries still opened by a running process. In the
+out-of-core mode the decoded movie is written straight in a new entry, so that
+it never needs to fit in memory.
+
+The cache folder is '~/.cache/SpotsFiltersTool' and the cap 50 GB, they can be
+changed with the SPOTSFILTER_CACHE_DIR and SPOTSFILTER_CACHE_GB environment
+variables (a cap of 0 disables the cache).
+"""
+
+
+import os
+import json
+import atexit
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:                      # Windows: byte range locks
+    fcntl  =  None
+    import msvcrt
+
+import FramesIndex
+
+
+CACHE_DIR   =  os.environ.get("SPOTSFILTER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "SpotsFiltersTool"))
+CACHE_CAP   =  float(os.environ.get("SPOTSFILTER_CACHE_GB", 50)) * 2 ** 30
+MTX_NAMES   =  ["green4D", "imarray_green", "imarray_red"]
+PIN_PREFIX  =  "pin."                    # files marking the processes using an entry, locked while the process runs
+
+
+held_pins  =  {}                         # entry folder: pin file kept open (and locked) by the current process
+
+
+def lock(pin_file):
+    """Exclusive non blocking lock of an open pin file, OSError if another process (or another open of the file) holds it."""
+    if fcntl is not None:
+        fcntl.flock(pin_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        msvcrt.locking(pin_file.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def pin(entry_dir):
+    """Pin an entry to the current process: the pin stays locked until the process ends."""
+    if entry_dir in held_pins:
+        return
+    pin_file  =  open(os.path.join(entry_dir, PIN_PREFIX + str(os.getpid())), "a+")
+    try:
+        lock(pin_file)
+    except OSError:
+        pin_file.close()
+        raise
+    held_pins[entry_dir]  =  pin_file
+
+
+@atexit.register
+def unpin_all():
+    """Remove the pins of the current process."""
+    for entry_dir, pin_file in list(held_pins.items()):
+        pin_file.close()
+        try:
+            os.remove(pin_file.name)
+        except OSError:
+            pass
+        del held_pins[entry_dir]
+
+
+def entry_size(entry_dir):
+    """Disk space taken by a cache entry, in bytes."""
+    return sum(os.path.getsize(os.path.join(entry_dir, fname)) for fname in os.listdir(entry_dir))
+
+
+class RawDataCache:
+    """Cache of decoded raw data, with LRU eviction."""
+    def __init__(self, cache_dir=CACHE_DIR, cache_cap=CACHE_CAP):
+
+        self.cache_dir  =  cache_dir
+        self.cache_cap  =  cache_cap
+
+    def key(self, fnames, nucs_spts_ch, crop_vect, im_red_smpl):
+        """Key of an entry: raw files, channels, crop and sample frames (which give the frame window)."""
+        files_info  =  [[os.path.abspath(fname), os.path.getsize(fname), os.path.getmtime(fname)] for fname in sorted(fnames)]
+        key_info    =  [files_info, np.asarray(nucs_spts_ch).tolist(), None if crop_vect is None else np.asarray(crop_vect).tolist(), FramesIndex.frame_fingerprint(im_red_smpl)]
+        return hashlib.blake2b(json.dumps(key_info).encode(), digest_size=16).hexdigest()
+
+    def load(self, key):
+        """Memory-mapped matrices and info of an entry, None if not in cache."""
+        entry_dir  =  os.path.join(self.cache_dir, key)
+        if self.cache_cap <= 0 or not os.path.isfile(os.path.join(entry_dir, "info.json")):
+            return None
+
+        try:
+            return self.open_entry(entry_dir)
+        except (OSError, ValueError):                                               # broken entry: decode again
+            return None
+
+    def open_entry(self, entry_dir):
+        """Memory-mapped matrices and info of an entry, which is pinned to the current process."""
+        with open(os.path.join(entry_dir, "info.json")) as info_file:
+            info  =  json.load(info_file)
+        mtxs  =  {name: np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode="r") for name in MTX_NAMES}             # read-only memory maps, no data read yet
+
+        try:
+            pin(entry_dir)                                                                  # worker processes open the files by name: the entry is not evicted while in use
+            os.utime(entry_dir)                                                             # last use, for the LRU eviction
+        except OSError:                                                                     # read only cache
+            pass
+        return mtxs, info
+
+    def new_entry(self):
+        """Temporary folder of a new entry, to be filled with the .npy files of the matrices and committed."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return tempfile.mkdtemp(prefix=".", dir=self.cache_dir)                     # entry is written aside and moved in place when complete
+
+    def commit(self, tmp_dir, key, info, keep=False):
+        """Move a filled temporary folder in place, removing the least recently used entries if the cap is passed.
+
+        Gives the folder of the entry, None if the entry does not fit the cap.
+        With keep the entry is kept even over the cap (out-of-core mode: the
+        matrices have to stay on disk anyway).
+        """
+        with open(os.path.join(tmp_dir, "info.json"), "w") as info_file:
+            json.dump(info, info_file)
+
+        new_size   =  entry_size(tmp_dir)
+        entries    =  [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if not name.startswith(".")]                              # complete entries only: no temporary folders or metadata records
+        entries    =  sorted([entry_dir for entry_dir in entries if os.path.isfile(os.path.join(entry_dir, "info.json"))], key=os.path.getmtime)           # least recently used first
+        used_size  =  sum(entry_size(entry_dir) for entry_dir in entries)
+        entries    =  [entry_dir for entry_dir in entries if not pinned(entry_dir)]                                                                     # entries opened by running processes are never removed
+        if not keep and used_size - sum(entry_size(entry_dir) for entry_dir in entries) + new_size > self.cache_cap:                                 # it would not fit even removing all the entries not in use
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+
+        while entries and used_size + new_size > self.cache_cap:
+            used_size  -=  entry_size(entries[0])
+            shutil.rmtree(entries.pop(0), ignore_errors=True)
+
+        entry_dir  =  os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir) and not complete(entry_dir):                    # broken entry with the same key (interrupted write, truncated file): replaced
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            if not complete(entry_dir):                                             # rename failed for another reason (files of the folder still mapped on Windows): nothing committed
+                raise
+            shutil.rmtree(tmp_dir, ignore_errors=True)                              # entry written meanwhile by another process, with the same matrices
+        return entry_dir
+
+    def store(self, key, mtxs, info):
+        """Write an entry, removing the least recently used ones if the cap is passed."""
+        new_size  =  sum(mtxs[name].nbytes for name in MTX_NAMES)
+        if self.cache_cap <= 0 or new_size > self.cache_cap:
+            return
+
+        tmp_dir  =  None
+        try:
+            tmp_dir  =  self.new_entry()
+            for name in MTX_NAMES:
+                np.save(os.path.join(tmp_dir, name + ".npy"), mtxs[name])
+            self.commit(tmp_dir, key, info)
+        except OSError:                                                             # disk full or read only folder: just no cache
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def complete(entry_dir):
+    """Check if an entry has its info and all its matrices readable."""
+    try:
+        with open(os.path.join(entry_dir, "info.json")) as info_file:
+            json.load(info_file)
+        for name in MTX_NAMES:
+            np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode="r")
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def pinned(entry_dir):
+    """Check if an entry is opened by a running process (the current one included); pins of ended processes are removed."""
+    if entry_dir in held_pins:
+        return True
+    for fname in os.listdir(entry_dir):
+        if fname.startswith(PIN_PREFIX):
+            try:
+                with open(os.path.join(entry_dir, fname), "a+") as pin_file:
+                    lock(pin_file)                                                  # lock taken: the process of the pin has ended (locks die with their process, whatever its pid became)
+            except OSError:                                                         # still locked by a running process (or not readable: kept, to be safe)
+                return True
+            try:
+                os.remove(os.path.join(entry_dir, fname))
+            except OSError:
+                pass
+    return False
@@ -0,0 +1,31 @@
+"""This function gives the reader of a raw data file.
+
+Raw data files are read by a backend chosen on the file extension: each backend
+is a couple of classes, one reading the metadata of the file (sizes, dtype,
+pixel sizes, time step, see CziMetadata) and one loading the projections and
+the green stack of a window of frames inside a crop rectangle (see LoadCzi5D).
+Tiff and lsm files are read with tifffile through memory maps, so large
+uncompressed exports are cropped and projected without being copied in memory.
+New formats are added with a new entry in BACKENDS.
+"""
+
+
+import os
+
+import LoadCzi5D
+import LoadTiff5D
+import CziMetadata
+
+
+BACKENDS  =  {".czi": (CziMetadata.CziMetadata, LoadCzi5D.LoadCzi5D),
+              ".tif": (LoadTiff5D.TiffMetadata, LoadTiff5D.LoadTiff5D),
+              ".tiff": (LoadTiff5D.TiffMetadata, LoadTiff5D.LoadTiff5D),
+              ".lsm": (LoadTiff5D.TiffMetadata, LoadTiff5D.LoadTiff5D)}
+
+
+def reader(fname):
+    """Metadata and loader classes of a raw data file."""
+    ext  =  os.path.splitext(str(fname))[1].lower()
+    if ext not in BACKENDS:
+        raise ValueError("no reader for " + ext + " files")
+    return BACKENDS[ext]
@@ -0,0 +1,55 @@
+"""This function collects the service widgets shared by the computing modules.
+
+Progress bars are given by 'progress_bar': when no Qt application is running
+(batch runs on compute nodes, no display) a silent progress bar with the same
+methods is given instead of the widget.
+"""
+
+
+from PyQt5 import QtWidgets
+
+
+class ProgressBar(QtWidgets.QWidget):
+    """Simple progressbar widget."""
+    def __init__(self, parent=None, total1=20):
+        super().__init__(parent)
+        self.name_line1  =  QtWidgets.QLineEdit()
+
+        self.progressbar1  =  QtWidgets.QProgressBar()
+        self.progressbar1.setMinimum(1)
+        self.progressbar1.setMaximum(total1)
+
+        main_layout  =  QtWidgets.QGridLayout()
+        main_layout.addWidget(self.progressbar1, 0, 0)
+
+        self.setLayout(main_layout)
+        self.setWindowTitle("Progress")
+        self.setGeometry(500, 300, 300, 50)
+
+    def update_progressbar(self, val1):
+        """Progressbar updater"""
+        self.progressbar1.setValue(val1)
+        QtWidgets.qApp.processEvents()
+
+
+class SilentProgressBar:
+    """Progress bar with no widget, for runs without GUI."""
+    def __init__(self, parent=None, total1=20):
+
+        self.total1  =  total1
+
+    def show(self):
+        """Nothing to show."""
+
+    def update_progressbar(self, val1):
+        """Nothing to update."""
+
+    def close(self):
+        """Nothing to close."""
+
+
+def progress_bar(total1=20):
+    """Progress bar widget if a Qt application is running, silent progress bar otherwise."""
+    if QtWidgets.QApplication.instance() is None:
+        return SilentProgressBar(total1=total1)
+    return ProgressBar(total1=total1)
@@ -0,0 +1,138 @@
+"""This function manages a persistent pool of worker processes.
+
+The pool is created once per session and reused by all the multiprocessing
+stages (solidity of the spots, background estimation). Big matrices are not
+pickled into the jobs: they are copied once into shared memory blocks and
+the jobs only carry a small descriptor, so that workers read the matrices
+with zero copies. Matrices already memory mapped from a file (out-of-core mode,
+cached raw data) are not copied at all: workers map the same file.
+"""
+
+
+import os
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+
+attached_blocks  =  {}                  # shared memory blocks attached by the current (worker) process
+
+
+class SharedArray:
+    """Picklable descriptor of a matrix stored in a shared memory block or in a file."""
+    def __init__(self, name, shape, dtype, offset=None):
+
+        self.name    =  name
+        self.shape   =  shape
+        self.dtype   =  dtype
+        self.offset  =  offset                  # position of the matrix in the file, None for shared memory blocks
+
+
+def file_array(shared_arr):
+    """Read only memory map of a matrix stored in a file."""
+    return np.memmap(shared_arr.name, dtype=shared_arr.dtype, mode="r", offset=shared_arr.offset, shape=shared_arr.shape)
+
+
+def attach(*shared_arrs):
+    """Give the matrices stored in shared memory blocks, without copying them.
+
+    Blocks attached by previous jobs of the same worker and not needed by the
+    current one are detached, so that released blocks do not stay mapped.
+    """
+    names  =  [shared_arr.name for shared_arr in shared_arrs]
+    for name in list(attached_blocks):
+        if name not in names:
+            try:
+                attached_blocks[name].close()
+                del attached_blocks[name]
+            except BufferError:                                     # some matrix of a previous job is still alive, retry at the next job
+                pass
+
+    mtxs  =  []
+    for shared_arr in shared_arrs:
+        if shared_arr.offset is not None:
+            mtxs.append(file_array(shared_arr))
+            continue
+        if shared_arr.name not in attached_blocks:
+            attached_blocks[shared_arr.name]  =  shared_memory.SharedMemory(name=shared_arr.name)
+        mtxs.append(np.ndarray(shared_arr.shape, dtype=shared_arr.dtype, buffer=attached_blocks[shared_arr.name].buf))
+
+    return mtxs if len(mtxs) > 1 else mtxs[0]
+
+
+def balanced_chunks(loads, n_chunks):
+    """Edges of at most n_chunks contiguous, non empty chunks of the items with about the same total load.
+
+    Items without load are given a small load anyway, so that empty items are
+    spread among the chunks too.
+    """
+    cum_loads  =  np.cumsum(np.asarray(loads, dtype=np.float64) + 1e-3)
+    edges      =  np.searchsorted(cum_loads, np.linspace(0, cum_loads[-1], n_chunks + 1)[1:-1], side="right")
+    return np.unique(np.concatenate([[0], edges, [cum_loads.size]]))
+
+
+class SharedWorkerPool:
+    """Pool of worker processes with the shared memory blocks they work on."""
+    def __init__(self, processes=None):
+
+        if os.name == "posix":                                      # no tracker on Windows: blocks are freed when their last handle is closed
+            resource_tracker.ensure_running()                       # workers must share the tracker of the main process, or they would unlink the blocks when they stop
+        self.processes  =  processes or multiprocessing.cpu_count()
+        self.pool       =  multiprocessing.Pool(self.processes)
+        self.blocks     =  {}                                       # name: [shared memory block, matrix, persistent flag]
+
+    def share(self, mtx, persistent=False):
+        """Copy a matrix into a shared memory block and give its descriptor.
+
+        Matrices already living in a block of the pool are not copied again,
+        matrices memory mapped from a whole file are given as the file.
+        Persistent blocks are kept until the pool is closed, the others until
+        they are released.
+        """
+        if isinstance(mtx, np.memmap) and isinstance(mtx.base, mmap.mmap) and mtx.filename is not None and mtx.mode == "r":       # whole read only file mapping, not a view or a copy-on-write map
+            return SharedArray(mtx.filename, mtx.shape, mtx.dtype.str, mtx.offset)
+
+        for name, (shm, shm_mtx, shm_persistent) in self.blocks.items():
+            if shm_mtx.__array_interface__["data"][0] == mtx.__array_interface__["data"][0] and shm_mtx.shape == mtx.shape and shm_mtx.dtype == mtx.dtype and mtx.flags.c_contiguous:
+                return SharedArray(name, shm_mtx.shape, shm_mtx.dtype.str)
+
+        shm            =  shared_memory.SharedMemory(create=True, size=max(mtx.nbytes, 1))
+        shm_mtx        =  np.ndarray(mtx.shape, dtype=mtx.dtype, buffer=shm.buf)
+        shm_mtx[...]   =  mtx
+        self.blocks[shm.name]  =  [shm, shm_mtx, persistent]
+        return SharedArray(shm.name, shm_mtx.shape, shm_mtx.dtype.str)
+
+    def array(self, shared_arr):
+        """Matrix of a block of the pool, to be used in the main process in place of the original."""
+        if shared_arr.offset is not None:
+            return file_array(shared_arr)
+        return self.blocks[shared_arr.name][1]
+
+    def release(self, *shared_arrs):
+        """Free the non persistent blocks of the given descriptors."""
+        for shared_arr in shared_arrs:
+            if shared_arr.name in self.blocks and not self.blocks[shared_arr.name][2]:
+                shm, shm_mtx, _  =  self.blocks.pop(shared_arr.name)
+                del shm_mtx
+                try:
+                    shm.close()
+                except BufferError:                                 # the matrix is still used in the main process: memory is freed with its last view
+                    pass
+                shm.unlink()
+
+    def map(self, func, jobs_args):
+        """Run the jobs on the pool, results in the order of the jobs."""
+        return self.pool.map(func, jobs_args)
+
+    def imap_unordered(self, func, jobs_args):
+        """Run the jobs on the pool feeding the workers one job at a time, results as soon as they are ready."""
+        return self.pool.imap_unordered(func, jobs_args)
+
+    def close(self):
+        """Stop the workers and free all the blocks."""
+        self.pool.close()
+        self.pool.join()
+        for name in list(self.blocks):
+            self.blocks[name][2]  =  False
+            self.release(SharedArray(name, None, None))
@@ -0,0 +1,85 @@
+"""This function stores the spots matrices of an analysis as sparse columns.
+
+Tracked spots, intensities and volumes of the spots are (t, x, y) matrices with
+almost all the pixels at zero. They are saved in 'spots_sparse.npz' as columns,
+one row per pixel where at least one of them is not zero: the t, x, y
+coordinates of the pixel and its value in each matrix. Rows are sorted by time
+and the first row of each frame is stored, so that a dense frame (or the
+whole dense matrix) is rebuilt on demand with a single assignment.
+
+The dense .npy files are an optional export (SegmentTrack compatibility): the
+functions 'open_matrix' and 'matrix_header' read the .npy file of a matrix if
+it is in the folder (or linked to it, see LinkedFiles) and the sparse container
+otherwise.
+"""
+
+
+import os
+import numpy as np
+
+import LinkedFiles
+
+
+SPARSE_FNAME  =  "spots_sparse.npz"
+SPARSE_NAMES  =  ["spots_tracked", "spots_3D_ints", "spots_3D_vol"]
+
+
+def save_sparse(fname, mtxs):
+    """Save the (t, x, y) matrices of a dictionary, all with the same shape, as sparse columns."""
+    shape    =  next(iter(mtxs.values())).shape
+    nz_pxls  =  np.zeros(shape, dtype=bool)
+    for mtx in mtxs.values():
+        nz_pxls  |=  mtx != 0                                                                               # pixels not zero in at least one matrix
+
+    flat_coords                   =  np.flatnonzero(nz_pxls)                                                # sorted by time
+    t_coords, x_coords, y_coords  =  np.unravel_index(flat_coords, shape)
+
+    t_indptr  =  np.zeros(shape[0] + 1, dtype=np.int64)                                                     # first row of each frame
+    np.cumsum(np.bincount(t_coords, minlength=shape[0]), out=t_indptr[1:])
+
+    columns  =  {name: mtx.reshape(-1)[flat_coords] for name, mtx in mtxs.items()}
+    np.savez(fname, shape=np.array(shape), t_indptr=t_indptr, t_coords=t_coords.astype(np.uint16), x_coords=x_coords.astype(np.uint16), y_coords=y_coords.astype(np.uint16), **columns)
+
+
+class SparseSpots:
+    """Spots matrices read from the sparse columns, dense frames on demand."""
+    def __init__(self, fname):
+
+        with np.load(fname) as columns:
+            self.shape     =  tuple(int(n) for n in columns["shape"])
+            self.t_indptr  =  columns["t_indptr"]
+            self.t_coords  =  columns["t_coords"]
+            self.x_coords  =  columns["x_coords"]
+            self.y_coords  =  columns["y_coords"]
+            self.columns   =  {name: columns[name] for name in SPARSE_NAMES if name in columns.files}
+
+    def frame(self, name, t):
+        """Dense frame of a matrix."""
+        rows                                           =  slice(self.t_indptr[t], self.t_indptr[t + 1])
+        out                                            =  np.zeros(self.shape[1:], dtype=self.columns[name].dtype)
+        out[self.x_coords[rows], self.y_coords[rows]]  =  self.columns[name][rows]
+        return out
+
+    def dense(self, name):
+        """Dense (t, x, y) matrix."""
+        out                                               =  np.zeros(self.shape, dtype=self.columns[name].dtype)
+        out[self.t_coords, self.x_coords, self.y_coords]  =  self.columns[name]
+        return out
+
+
+def open_matrix(folder, name, mmap_mode="r"):
+    """Matrix of a folder: memory map of its .npy file if exported (or linked), rebuilt from the sparse columns otherwise."""
+    fname  =  LinkedFiles.resolve(folder, name + '.npy')
+    if os.path.isfile(fname) or name not in SPARSE_NAMES or not os.path.isfile(folder + '/' + SPARSE_FNAME):
+        return np.load(fname, mmap_mode=mmap_mode)
+    return SparseSpots(folder + '/' + SPARSE_FNAME).dense(name)
+
+
+def matrix_header(folder, name):
+    """Shape and dtype of a matrix of a folder, without reading it."""
+    fname  =  LinkedFiles.resolve(folder, name + '.npy')
+    if os.path.isfile(fname) or name not in SPARSE_NAMES or not os.path.isfile(folder + '/' + SPARSE_FNAME):
+        mtx  =  np.load(fname, mmap_mode="r")
+        return mtx.shape, mtx.dtype
+    with np.load(folder + '/' + SPARSE_FNAME) as columns:
+        return tuple(int(n) for n in columns["shape"]), columns[name].dtype
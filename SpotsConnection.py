@@ -1,75 +1,51 @@
 """This function associates detected spots to tracked nuclei.
 
 Starting from the mask of the detected spots, it searches for the closer nuclei
-and gives to the spot the same label of the found nucleus.
+and gives to the spot the same label of the found nucleus. Spots not
+overlapping any nucleus are assigned either with a square search around each
+of them (closer_engine="window") or with a lookup in the closer nuclei map
+of the frame (closer_engine="map"), giving the same labels.
 """
 
 
 import numpy as np
 from skimage.morphology import label
-from skimage.measure import regionprops
-from PyQt5 import QtWidgets
+from skimage.measure import regionprops_table
 
 import CloserNucleiFinder
+import ServiceWidgets
 
 
 class SpotsConnection:
     """Main class, does all the job."""
-    def __init__(self, nuclei_tracked, spots_mask, spt_nuc_maxdist):
+    def __init__(self, nuclei_tracked, spots_mask, spt_nuc_maxdist, closer_engine="window"):
 
-        spots_tracked   =  np.zeros(spots_mask.shape)
-        t_tot           =  spots_mask.shape[0]
-        spots_mask_lbl  =  np.zeros(spots_mask.shape)
+        t_tot          =  spots_mask.shape[0]
+        spots_tracked  =  np.zeros(spots_mask.shape, dtype=np.uint16 if nuclei_tracked.max() < 2 ** 16 else np.uint32)
 
-        pbar  =  ProgressBar(total1=3 * t_tot)
+        pbar  =  ServiceWidgets.progress_bar(total1=t_tot)
         pbar.show()
 
         for t in range(t_tot):
             pbar.update_progressbar(t)
-            spots_mask_lbl[t, :, :]  =  label(spots_mask[t, :, :])
-
-        for t in range(t_tot):
-            pbar.update_progressbar(t_tot + t)
-            a  =  np.unique(spots_mask_lbl[t, :, :])[1:]
-            for k in a:
-                spots_tracked[t, :, :]  +=  (spots_mask_lbl[t, :, :] == k) * ((spots_mask_lbl[t, :, :] == k) * nuclei_tracked[t, :, :]).max()
-
-        left      =  np.sign(spots_mask) - np.sign(spots_tracked)
-        left_lbl  =  np.zeros(left.shape)
-        for t in range(t_tot):
-            left_lbl[t, :, :]  =  label(left[t, :, :])
-
-        for tt in range(t_tot):
-            pbar.update_progressbar(2 * t_tot + tt)
-            rgp  =  regionprops(left_lbl[tt, :, :].astype(int))
-            for kk in range(len(rgp)):
-                m                        =   CloserNucleiFinder.CloserNucleiFinder(nuclei_tracked[tt, :, :], np.array([int(rgp[kk]["Centroid"][0]), int(rgp[kk]["Centroid"][1])]), spt_nuc_maxdist).mx_pt
-                spots_tracked[tt, :, :]  +=  (left_lbl[tt, :, :] == rgp[kk]['label']).astype(int) * m
+            spots_lbl  =  label(spots_mask[t, :, :])
+            nz_coords  =  np.nonzero(spots_lbl)                                                             # pixels of the spots in the frame
+            spots_nuc  =  np.zeros(spots_lbl.max() + 1, dtype=spots_tracked.dtype)                          # label of the nucleus each spot overlaps (0 if none)
+            np.maximum.at(spots_nuc, spots_lbl[nz_coords], nuclei_tracked[t][nz_coords])                    # all the spots at once, with the max of the nuclei labels under each spot
+
+            orphans  =  np.where(spots_nuc[1:] == 0)[0] + 1                                                 # spots not overlapping any nucleus
+            if orphans.size > 0:
+                rgp       =  regionprops_table(spots_lbl, properties=["label", "centroid"])
+                orph_idx  =  np.where(np.isin(rgp["label"], orphans))[0]
+                orph_ctr  =  rgp["centroid-0"][orph_idx].astype(int), rgp["centroid-1"][orph_idx].astype(int)
+                if closer_engine == "map":                                                                  # closer nucleus of all the pixels from the distance transform, then a lookup per spot
+                    spots_nuc[rgp["label"][orph_idx]]  =  CloserNucleiFinder.CloserNucleiMap(nuclei_tracked[t, :, :], spt_nuc_maxdist).mx_map[orph_ctr]
+                else:                                                                                       # growing square search around each spot
+                    for cnt, kk in enumerate(orph_idx):
+                        spots_nuc[rgp["label"][kk]]  =  CloserNucleiFinder.CloserNucleiFinder(nuclei_tracked[t, :, :], np.array([orph_ctr[0][cnt], orph_ctr[1][cnt]]), spt_nuc_maxdist).mx_pt
+
+            spots_tracked[t][nz_coords]  =  spots_nuc[spots_lbl[nz_coords]]                                 # label-indexed assignment of all the spots of the frame
 
         pbar.close()
 
         self.spots_tracked  =  spots_tracked
-        # self.left_lbl       =  left_lbl
-
-
-class ProgressBar(QtWidgets.QWidget):
-    """Simple progressbar widget."""
-    def __init__(self, parent=None, total1=20):
-        super().__init__(parent)
-        self.name_line1  =  QtWidgets.QLineEdit()
-
-        self.progressbar1  =  QtWidgets.QProgressBar()
-        self.progressbar1.setMinimum(1)
-        self.progressbar1.setMaximum(total1)
-
-        main_layout  =  QtWidgets.QGridLayout()
-        main_layout.addWidget(self.progressbar1, 0, 0)
-
-        self.setLayout(main_layout)
-        self.setWindowTitle("Progress")
-        self.setGeometry(500, 300, 300, 50)
-
-    def update_progressbar(self, val1):
-        """Update progressbar."""
-        self.progressbar1.setValue(val1)
-        QtWidgets.qApp.processEvents()
@@ -0,0 +1,202 @@
+"""Headless batch version of 'SpotsFilterTool', to run on compute nodes.
+
+It filters and saves several analysis folders with the same steps of the
+Filter and Save buttons of the GUI, with no window and no file dialog.
+Embryos are processed concurrently, each in its own process with its own pool
+of workers, and a new embryo is started only if its estimated memory fits the
+memory budget left by the running ones.
+
+Usage:
+    python SpotsFilterBatch.py config.ini [--memory-budget GB] [--max-embryos N] [--processes N]
+
+The config file has a section per embryo; values in the [DEFAULT] section are
+shared by all the embryos and the [batch] section sets the scheduler:
+
+    [DEFAULT]
+    solidity_thr     =  4
+    numb_zeros_frst  =  3
+    numb_zeros_scnd  =  2
+    numb_zeros_thrd  =  1
+    slot_end_frst    =  40
+    slot_end_scnd    =  80
+
+    [batch]
+    memory_budget_gb  =  64
+    max_embryos       =  4
+
+    [embryo1]
+    analysis_folder  =  /data/embryo1_analysis
+    raw_files        =  /data/raw/embryo1_*.czi
+
+Leave 'solidity_thr' empty to skip the one spot per nucleus filter. Slot
+starts and the end of the third slot are optional: as in the GUI, each slot
+starts the frame after the end of the previous one and the third one ends at
+the last frame.
+
+Set 'out_of_core_gb' (in [DEFAULT] or in the section of an embryo) to process
+movies bigger than the memory: the raw movie is decoded on disk in the raw
+data cache (see RawDataCache) and loading, background estimation and saving
+work on windows of frames fitting the given memory budget in GB. Only the raw
+movie and the false colored video are streamed: the label matrices (tracked
+nuclei and spots, spots to remove), the spots connection and the filters
+still work on whole (t, x, y) matrices, which must fit in memory. Set
+'dense_export  =  no' to save tracked spots, intensities and volumes only as
+sparse columns (see SparseSpots), without their dense .npy files. Set
+'link_inputs  =  link' to reflink or hard link the nuclei, crop, sample frames
+and channels of the analysis in the parallel folder instead of copying them
+(a manifest pointing to the analysis folder is written when the filesystem
+allows no link), or 'link_inputs  =  manifest' to always write the manifest
+(see LinkedFiles).
+"""
+
+
+import sys
+import glob
+import argparse
+import configparser
+import multiprocessing
+from multiprocessing.connection import wait
+import traceback
+import numpy as np
+
+import AnalysisLoader
+import SpotsSeveralFilters
+import AnalysisSaver
+import SpotsPixelIndex
+import SharedWorkerPool
+import MemoryPlanner
+import SparseSpots
+
+
+def out_of_core_budget(params):
+    """Memory budget in bytes of the out-of-core mode, None if not set."""
+    return params.getfloat("out_of_core_gb") * 2 ** 30 if params.get("out_of_core_gb", "").strip() else None
+
+
+class EmbryoSpotsFilter:
+    """Filter the spots of an analysis folder and save the results in the parallel folder."""
+    def __init__(self, analysis_folder, fnames, params, workers):
+
+        raw_data          =  AnalysisLoader.RawData(analysis_folder, fnames, out_of_core_budget(params), workers.processes)     # out-of-core if set or if the embryo does not fit in memory
+        memory_budget     =  raw_data.memory_budget
+        raw_data.green4D  =  workers.array(workers.share(raw_data.green4D, persistent=True))                     # big matrices are moved once into shared memory (or mapped from their file), workers read them from there
+        spts_track        =  workers.array(workers.share(SparseSpots.open_matrix(analysis_folder, 'spots_tracked'), persistent=True))      # mapped from its .npy file, or rebuilt from the sparse columns and copied in shared memory
+        spts_index        =  SpotsPixelIndex.SpotsPixelIndex(spts_track)
+
+        slot_strt_frst  =  params.getint("slot_strt_frst", 0)
+        slot_end_frst   =  params.getint("slot_end_frst")
+        slot_strt_scnd  =  params.getint("slot_strt_scnd", slot_end_frst + 1)
+        slot_end_scnd   =  params.getint("slot_end_scnd")
+        slot_strt_thrd  =  params.getint("slot_strt_thrd", slot_end_scnd + 1)
+        slot_end_thrd   =  params.getint("slot_end_thrd", raw_data.imarray_green.shape[0])
+        slots_values    =  [params.getint("numb_zeros_frst"), params.getint("numb_zeros_scnd"), params.getint("numb_zeros_thrd"), slot_strt_frst, slot_end_frst, slot_strt_scnd, slot_end_scnd, slot_strt_thrd, slot_end_thrd]
+        solidity_thr    =  params.getint("solidity_thr") if params.get("solidity_thr", "").strip() else None
+
+        if solidity_thr is not None:
+            spts2rm_1  =  SpotsSeveralFilters.OneSpotsPerNucleus(spts_track, solidity_thr, None, workers).spts2rm
+            spts2rm_2  =  SpotsSeveralFilters.RemoveIsolatedSpots(spts_track * (1 - spts2rm_1), *slots_values, spts_index.remove(spts2rm_1)).spts2rm
+            spts2rm    =  np.sign(spts2rm_1 + spts2rm_2)
+        else:
+            spts2rm  =  SpotsSeveralFilters.RemoveIsolatedSpots(spts_track, *slots_values, spts_index).spts2rm
+
+        spots_3D  =  SpotsSeveralFilters.FilteredSpots2Save(analysis_folder, spts2rm)
+        AnalysisSaver.FilteredSpotsSaver(analysis_folder, spots_3D, raw_data.fnames, raw_data.green4D, solidity_thr, *slots_values, workers, show_plot=False, memory_budget=memory_budget, dense_export=params.getboolean("dense_export", True), link_mode=params.get("link_inputs", "copy"))
+
+        self.spts2rm  =  spts2rm
+
+
+class BatchEmbryo:
+    """Settings of an embryo of the batch, with its estimated memory."""
+    def __init__(self, name, params, processes=None):
+
+        self.name             =  name
+        self.params           =  params
+        self.analysis_folder  =  params["analysis_folder"]
+        self.fnames           =  sorted(set(fname for pattern in params["raw_files"].split() for fname in glob.glob(pattern)))
+        if len(self.fnames) == 0:
+            raise ValueError("No raw files found for " + name + ": " + params["raw_files"])
+
+        planner        =  MemoryPlanner.MemoryPlanner(self.analysis_folder, self.fnames, processes)              # from the headers of the raw files and of the analysis matrices, with the workers of the embryo
+        memory_budget  =  out_of_core_budget(params)
+        self.memory    =  planner.peak if memory_budget is None else planner.lean_fixed + memory_budget           # out-of-core: the raw movie stays on disk
+
+
+def filter_embryo(analysis_folder, fnames, params, processes):
+    """Process target: filter an embryo with its own pool of workers."""
+    workers  =  SharedWorkerPool.SharedWorkerPool(processes)
+    try:
+        EmbryoSpotsFilter(analysis_folder, fnames, params, workers)
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        workers.close()
+
+
+class BatchScheduler:
+    """Run the embryos concurrently within the memory budget, gives the names of the failed ones."""
+    def __init__(self, embryos, memory_budget, max_embryos, processes):
+
+        pending  =  list(embryos)
+        running  =  {}                                                              # process sentinel: [embryo, process]
+        failed   =  []
+
+        while pending or running:
+            used_memory  =  sum(embryo.memory for embryo, _ in running.values())
+            while pending and len(running) < max_embryos and (not running or used_memory + pending[0].memory <= memory_budget):     # an embryo alone always runs, even over budget
+                embryo  =  pending.pop(0)
+                proc    =  multiprocessing.Process(target=filter_embryo, args=(embryo.analysis_folder, embryo.fnames, embryo.params, processes), name=embryo.name, daemon=False)     # not daemonic: each embryo launches its own pool of workers
+                proc.start()
+                print("started " + embryo.name + " (" + str(np.round(embryo.memory / 2 ** 30, 2)) + " GB estimated)")
+                running[proc.sentinel]  =  [embryo, proc]
+                used_memory            +=  embryo.memory
+
+            for sentinel in wait(list(running)):                                    # wait for at least an embryo to finish
+                embryo, proc  =  running.pop(sentinel)
+                proc.join()
+                if proc.exitcode != 0:
+                    failed.append(embryo.name)
+                print(embryo.name + (" done" if proc.exitcode == 0 else " failed"))
+
+        self.failed  =  failed
+
+
+def main(argv=None):
+    """Read the config file and run the batch."""
+    parser  =  argparse.ArgumentParser(description="Filter the spots of several analysis folders without GUI.")
+    parser.add_argument("config", help="config file with the analysis folders, raw files and filter parameters")
+    parser.add_argument("--memory-budget", type=float, help="memory budget in GB for all the running embryos (default: available memory)")
+    parser.add_argument("--max-embryos", type=int, help="maximum number of embryos processed concurrently")
+    parser.add_argument("--processes", type=int, help="number of worker processes of each embryo")
+    args  =  parser.parse_args(argv)
+
+    config  =  configparser.ConfigParser()
+    if not config.read(args.config):
+        parser.error("cannot read " + args.config)
+
+    batch          =  config["batch"] if config.has_section("batch") else config[config.default_section]
+    names          =  [name for name in config.sections() if name != "batch"]
+    available      =  MemoryPlanner.available_memory()
+    memory_budget  =  (args.memory_budget or batch.getfloat("memory_budget_gb", np.inf if available is None else available / 2 ** 30)) * 2 ** 30     # no limit if memory cannot be measured
+    max_embryos    =  args.max_embryos or batch.getint("max_embryos", min(len(names), multiprocessing.cpu_count()))
+    processes      =  args.processes or batch.getint("processes", max(multiprocessing.cpu_count() // max(max_embryos, 1), 1))    # cores are split among the concurrent embryos
+
+    embryos  =  []
+    failed   =  []
+    for name in names:                                                              # memory estimated with the workers each embryo will have
+        try:
+            embryos.append(BatchEmbryo(name, config[name], processes))
+        except Exception:                                                           # unreadable folder or files, embryo that does not fit at all: the others run anyway
+            traceback.print_exc()
+            print(name + " failed")
+            failed.append(name)
+
+    failed  +=  BatchScheduler(embryos, memory_budget, max_embryos, processes).failed
+    if failed:
+        print("failed: " + ", ".join(failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
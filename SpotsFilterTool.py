@@ -17,6 +17,9 @@ from skimage.morphology import label
 import AnalysisLoader
 import SpotsSeveralFilters
 import AnalysisSaver
+import SpotsPixelIndex
+import SharedWorkerPool
+import SparseSpots
 
 
 class SpotsFilterTool(QtWidgets.QWidget):
@@ -28,17 +31,25 @@ class SpotsFilterTool(QtWidgets.QWidget):
 
         analysis_folder  =  str(QtWidgets.QFileDialog.getExistingDirectory(None, "Select the folder with the analyzed data"))
 
-        raw_data     =  AnalysisLoader.RawData(analysis_folder)
-        spts_track   =  np.load(analysis_folder + '/spots_tracked.npy')
-        nucs_track   =  np.load(analysis_folder + '/nuclei_tracked.npy') * (1 - np.sign(spts_track))
-        spts_rmvd    =  np.zeros_like(spts_track)
-        spots2show   =  np.sign(spts_track) + np.sign(spts_rmvd) + np.sign(nucs_track) * 3
-        bin_cmap     =  np.zeros((4, 3), dtype='uint16')
-        bin_cmap[0]  =  [0, 0, 0]
-        bin_cmap[1]  =  [0, 255, 0]
-        bin_cmap[2]  =  [255, 0, 0]
-        bin_cmap[3]  =  [0, 0, 255]
-        mycmap       =  pg.ColorMap(np.linspace(0, 1, 4), color=bin_cmap)
+        workers           =  SharedWorkerPool.SharedWorkerPool()                                               # worker processes of the session, reused at each Filter and Save
+        try:
+            raw_data  =  AnalysisLoader.RawData(analysis_folder, processes=workers.processes)                       # memory is estimated before loading, with the workers of the session
+        except MemoryError as err:
+            QtWidgets.QMessageBox.critical(None, "Not enough memory", str(err))
+            workers.close()
+            raise
+        raw_data.green4D  =  workers.array(workers.share(raw_data.green4D, persistent=True))                     # big matrices are moved once into shared memory, workers read them from there
+        spts_track        =  workers.array(workers.share(SparseSpots.open_matrix(analysis_folder, 'spots_tracked'), persistent=True))      # workers map the same file if exported as .npy, rebuilt from the sparse columns and copied once in shared memory otherwise
+        spts_index        =  SpotsPixelIndex.SpotsPixelIndex(spts_track)
+        nucs_track        =  SparseSpots.open_matrix(analysis_folder, 'nuclei_tracked') * (1 - np.sign(spts_track))
+        spts_rmvd         =  np.zeros(spts_track.shape, dtype=spts_track.dtype)
+        spots2show        =  np.sign(spts_track) + np.sign(spts_rmvd) + np.sign(nucs_track) * 3
+        bin_cmap          =  np.zeros((4, 3), dtype='uint16')
+        bin_cmap[0]       =  [0, 0, 0]
+        bin_cmap[1]       =  [0, 255, 0]
+        bin_cmap[2]       =  [255, 0, 0]
+        bin_cmap[3]       =  [0, 0, 255]
+        mycmap            =  pg.ColorMap(np.linspace(0, 1, 4), color=bin_cmap)
 
         frame1  =  pg.ImageView(self, name="Frame1")
         frame1.ui.menuBtn.hide()
@@ -153,6 +164,12 @@ class SpotsFilterTool(QtWidgets.QWidget):
         spots_filter_btn.setFixedSize(int(ksf_h * 120), int(ksf_w * 25))
         spots_filter_btn.clicked[bool].connect(self.spots_filter)
 
+        dense_npy_checkbox  =  QtWidgets.QCheckBox(self)
+        dense_npy_checkbox.setFixedSize(int(ksf_h * 120), int(ksf_h * 25))
+        dense_npy_checkbox.setText("Dense .npy")
+        dense_npy_checkbox.setToolTip("Saves tracked spots, intensities and volumes also as dense .npy files (read by SegmentTrack), not only as sparse columns")
+        dense_npy_checkbox.setChecked(True)
+
         save_filtspts_btn  =  QtWidgets.QPushButton("Save", self)
         save_filtspts_btn.clicked.connect(self.save_filtspts)
         save_filtspts_btn.setToolTip("Save filtered time series")
@@ -172,6 +189,7 @@ class SpotsFilterTool(QtWidgets.QWidget):
         commands.addWidget(groupbox)
         commands.addWidget(spots_filter_btn)
         commands.addStretch()
+        commands.addWidget(dense_npy_checkbox)
         commands.addWidget(save_filtspts_btn)
         commands.addWidget(frame_numb_lbl)
 
@@ -183,8 +201,11 @@ class SpotsFilterTool(QtWidgets.QWidget):
         self.frame1              =  frame1
         self.frame2              =  frame2
         self.one_spot_checkbox   =  one_spot_checkbox
+        self.dense_npy_checkbox  =  dense_npy_checkbox
         self.nucs_track          =  nucs_track
         self.spts_track          =  spts_track
+        self.spts_index          =  spts_index
+        self.workers             =  workers
         self.spots2show          =  spots2show
         self.frame_numb_lbl      =  frame_numb_lbl
         self.spots_filter_btn    =  spots_filter_btn
@@ -192,7 +213,8 @@ class SpotsFilterTool(QtWidgets.QWidget):
         self.analysis_folder     =  analysis_folder
         self.raw_data            =  raw_data
         self.solidity_thr_edt    =  solidity_thr_edt
-        self.spts2rm             =  np.zeros_like(spts_track)
+        self.spts2rm             =  np.zeros(spts_track.shape, dtype=spts_track.dtype)
+        self.solidity_table      =  None
         self.slot_end_frst_edt   =  slot_end_frst_edt
         self.slot_strt_scnd_edt  =  slot_strt_scnd_edt
         self.slot_end_scnd_edt   =  slot_end_scnd_edt
@@ -269,12 +291,14 @@ class SpotsFilterTool(QtWidgets.QWidget):
         QtWidgets.QApplication.processEvents()
         QtWidgets.QApplication.processEvents()
         if self.one_spot_checkbox.checkState() != 0:
-            spts2rm_1        =  SpotsSeveralFilters.OneSpotsPerNucleus(self.spts_track, self.solidity_thr_value).spts2rm
-            spts2rm_2        =  SpotsSeveralFilters.RemoveIsolatedSpots(self.spts_track * (1 - spts2rm_1), self.numb_zeros_frst_value, self.numb_zeros_scnd_value, self.numb_zeros_thrd_value, self.slot_strt_frst_value, self.slot_end_frst_value, self.slot_strt_scnd_value, self.slot_end_scnd_value, self.slot_strt_thrd_value, self.slot_end_thrd_value).spts2rm
-            self.spts2rm     =  np.sign(spts2rm_1 + spts2rm_2)
-            self.spots2show  =  np.sign(self.spts_track)  +  self.spts2rm  +  np.sign(self.nucs_track) * 3
+            one_spot             =  SpotsSeveralFilters.OneSpotsPerNucleus(self.spts_track, self.solidity_thr_value, self.solidity_table, self.workers)   # solidities are computed only at the first run, then just thresholded
+            self.solidity_table  =  one_spot.solidity_table
+            spts2rm_1            =  one_spot.spts2rm
+            spts2rm_2            =  SpotsSeveralFilters.RemoveIsolatedSpots(self.spts_track * (1 - spts2rm_1), self.numb_zeros_frst_value, self.numb_zeros_scnd_value, self.numb_zeros_thrd_value, self.slot_strt_frst_value, self.slot_end_frst_value, self.slot_strt_scnd_value, self.slot_end_scnd_value, self.slot_strt_thrd_value, self.slot_end_thrd_value, self.spts_index.remove(spts2rm_1)).spts2rm
+            self.spts2rm         =  np.sign(spts2rm_1 + spts2rm_2)
+            self.spots2show      =  np.sign(self.spts_track)  +  self.spts2rm  +  np.sign(self.nucs_track) * 3
         else:
-            self.spts2rm     =  SpotsSeveralFilters.RemoveIsolatedSpots(self.spts_track, self.numb_zeros_frst_value, self.numb_zeros_scnd_value, self.numb_zeros_thrd_value, self.slot_strt_frst_value, self.slot_end_frst_value, self.slot_strt_scnd_value, self.slot_end_scnd_value, self.slot_strt_thrd_value, self.slot_end_thrd_value).spts2rm
+            self.spts2rm     =  SpotsSeveralFilters.RemoveIsolatedSpots(self.spts_track, self.numb_zeros_frst_value, self.numb_zeros_scnd_value, self.numb_zeros_thrd_value, self.slot_strt_frst_value, self.slot_end_frst_value, self.slot_strt_scnd_value, self.slot_end_scnd_value, self.slot_strt_thrd_value, self.slot_end_thrd_value, self.spts_index).spts2rm
             self.spots2show  =  np.sign(self.spts_track)  +  self.spts2rm  +  np.sign(self.nucs_track) * 3
 
         cif  =  self.frame1.currentIndex
@@ -288,7 +312,7 @@ class SpotsFilterTool(QtWidgets.QWidget):
         QtWidgets.QApplication.processEvents()
         QtWidgets.QApplication.processEvents()
         spots_3D          =  SpotsSeveralFilters.FilteredSpots2Save(self.analysis_folder, self.spts2rm)
-        AnalysisSaver.FilteredSpotsSaver(self.analysis_folder, spots_3D, self.raw_data.fnames, self.raw_data.green4D, self.solidity_thr_value, self.numb_zeros_frst_value, self.numb_zeros_scnd_value, self.numb_zeros_thrd_value, self.slot_strt_frst_value, self.slot_end_frst_value, self.slot_strt_scnd_value, self.slot_end_scnd_value, self.slot_strt_thrd_value, self.slot_end_thrd_value)
+        AnalysisSaver.FilteredSpotsSaver(self.analysis_folder, spots_3D, self.raw_data.fnames, self.raw_data.green4D, self.solidity_thr_value, self.numb_zeros_frst_value, self.numb_zeros_scnd_value, self.numb_zeros_thrd_value, self.slot_strt_frst_value, self.slot_end_frst_value, self.slot_strt_scnd_value, self.slot_end_scnd_value, self.slot_strt_thrd_value, self.slot_end_thrd_value, self.workers, memory_budget=self.raw_data.memory_budget, dense_export=self.dense_npy_checkbox.isChecked())
         self.save_filtspts_btn.setStyleSheet("background-color : white")
 
     def click(self, event):
@@ -307,6 +331,11 @@ class SpotsFilterTool(QtWidgets.QWidget):
                 self.spots2show[self.frame2.currentIndex]  -=  (spts_bff == spts_bff[pos[0], pos[1]])
             self.frame2.updateImage()
 
+    def closeEvent(self, event):
+        """Stop the worker processes of the session when the tool is closed."""
+        self.workers.close()
+        event.accept()
+
 def except_hook(cls, exception, traceback):
     sys.__excepthook__(cls, exception, traceback)
 
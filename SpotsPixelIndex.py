@@ -0,0 +1,75 @@
+"""This function builds a sparse index of the pixels of the tracked spots.
+
+Given the tracked spots matrix (t, x, y), it stores for each spot label the
+time and flat-pixel coordinates of all its pixels in CSR style: the pixels
+of the spot in row k of 'spts_idxs' are the entries indptr[k]:indptr[k + 1]
+of 't_coords' and 'pix_coords', sorted by time. The index is built with a
+single pass over the volume, so all the per-label work done on top of it
+costs only the number of pixels of that label.
+"""
+
+
+import copy
+import numpy as np
+
+
+class SpotsPixelIndex:
+    """Only class, does all the job."""
+    def __init__(self, spts_track):
+
+        tlen, xlen, ylen  =  spts_track.shape
+        flat_coords       =  np.flatnonzero(spts_track)                                             # flat (t, x, y) coordinates of all the spots pixels, sorted by time
+        lbls              =  spts_track.reshape(-1)[flat_coords]
+        order             =  np.argsort(lbls, kind="stable")                                        # group pixels by label keeping the time order
+        flat_coords       =  flat_coords[order]
+
+        spts_idxs, spts_npix  =  np.unique(lbls[order], return_counts=True)                         # labels and number of pixels of each spot
+        indptr                =  np.zeros(spts_idxs.size + 1, dtype=np.int64)
+        np.cumsum(spts_npix, out=indptr[1:])
+
+        self.shape       =  spts_track.shape
+        self.dtype       =  spts_track.dtype
+        self.spts_idxs   =  spts_idxs
+        self.indptr      =  indptr
+        self.t_coords    =  (flat_coords // (xlen * ylen)).astype(np.int32)
+        self.pix_coords  =  flat_coords % (xlen * ylen)
+
+    def rows(self, lbls):
+        """Row of the index of each label in lbls."""
+        return np.searchsorted(self.spts_idxs, lbls)
+
+    def pixels(self, row):
+        """Time and flat-pixel coordinates of the spot in a given row."""
+        return self.t_coords[self.indptr[row]:self.indptr[row + 1]], self.pix_coords[self.indptr[row]:self.indptr[row + 1]]
+
+    def flat_coords(self):
+        """Flat (t, x, y) coordinates of all the indexed pixels."""
+        return self.t_coords.astype(np.int64) * (self.shape[1] * self.shape[2]) + self.pix_coords
+
+    def pixels_rows(self):
+        """Row of the index of each indexed pixel."""
+        return np.repeat(np.arange(self.spts_idxs.size), np.diff(self.indptr))
+
+    def activity_matrix(self):
+        """Spots x time 0/1 activity matrix."""
+        activity                                     =  np.zeros((self.spts_idxs.size, self.shape[0]), dtype=np.uint8)
+        activity[self.pixels_rows(), self.t_coords]  =  1
+        return activity
+
+    def write_back(self, spts_t_values):
+        """Paint a spots x time matrix of values on the pixels of the corresponding spots."""
+        out                                  =  np.zeros(self.shape, dtype=self.dtype)
+        out.reshape(-1)[self.flat_coords()]  =  spts_t_values[self.pixels_rows(), self.t_coords]
+        return out
+
+    def remove(self, spts2rm):
+        """Index of the same spots without the pixels tagged in spts2rm (full volume matrix)."""
+        keep       =  spts2rm.reshape(-1)[self.flat_coords()] == 0
+        keep_rows  =  np.bincount(self.pixels_rows()[keep], minlength=self.spts_idxs.size)                 # number of pixels left for each spot
+        new_index  =  copy.copy(self)
+
+        new_index.spts_idxs   =  self.spts_idxs[keep_rows > 0]
+        new_index.indptr      =  np.concatenate([[0], np.cumsum(keep_rows[keep_rows > 0])]).astype(np.int64)
+        new_index.t_coords    =  self.t_coords[keep]
+        new_index.pix_coords  =  self.pix_coords[keep]
+        return new_index
@@ -4,12 +4,12 @@ Input is the tracked spots and filter settings.
 """
 
 
-import multiprocessing
 import numpy as np
 from skimage.measure import regionprops_table, label
-from skimage.morphology import convex_hull_image
-from PyQt5 import QtWidgets
 
+import SpotsPixelIndex
+import SharedWorkerPool
+import SparseSpots
 # import ServiceWidgets
 
 
@@ -24,64 +24,108 @@ def build3d_from_coords(spots_coords, t):
 
 class OneSpotsPerNucleus:
     """Keeps only one spot per nucleus, the biggest one."""
-    def __init__(self, spts_track, solidity_thr):
+    def __init__(self, spts_track, solidity_thr, solidity_table=None, workers=None):
 
-        tlen        =  spts_track.shape[0]                                                                              # number of time frames
-        cpu_owe     =  min(multiprocessing.cpu_count(), 16)                                                             # number of cpu (maximum of 16 for Virginia pc)
-        jobs_args   =  []                                                                                               # initialize the list of the arguments
-        sub_frames  =  np.array_split(np.arange(tlen), cpu_owe)                                                         # split the total number of time frames in nearly egual chops
-        for sub in sub_frames:
-            jobs_args.append([spts_track[sub], solidity_thr])                                                           # populate the list
-
-        pool     =  multiprocessing.Pool()                                                                              # launch the multiprocessing pool
-        results  =  pool.map(OneSpotsPerNucleusUtility, jobs_args)
-
-        spts2rm  =  np.zeros_like(spts_track)                                                                           # initialize the output matrix
-        for cnt, sub_frame in enumerate(sub_frames):
-            spts2rm[sub_frame]  =  results[cnt].spts2rm
+        if solidity_table is None:                                                                                      # the table depends only on the tracked spots: compute it once and reuse it for any threshold
+            solidity_table  =  SolidityTable(spts_track, workers)
 
-        self.spts2rm  =  spts2rm
+        self.spts2rm         =  solidity_table.spts2rm(solidity_thr)
+        self.solidity_table  =  solidity_table
 
 
-class OneSpotsPerNucleusUtility:
-    """Keeps only one spot per nucleus, the biggest one."""
-    def __init__(self, job_args):
-
-        spts_track    =  job_args[0]
-        solidity_thr  =  job_args[1]
+class SolidityTable:
+    """Solidity of each spot in each frame, with the pixels to remove to keep only its biggest connected component."""
+    def __init__(self, spts_track, workers=None):
 
-        tlen     =  spts_track.shape[0]                                                                                 # number of time steps
-        spts2rm  =  np.zeros_like(spts_track)                                                                           # initialize the matrix of the spots to remove
+        own_workers  =  workers is None
+        if own_workers:
+            workers  =  SharedWorkerPool.SharedWorkerPool()                                                             # launch a multiprocessing pool just for this job
 
-        for tt in range(tlen):
-            rgp       =  regionprops_table(spts_track[tt], properties=["label", "area"])                                # regionprops of the tracked spots
-            cv_im     =  []
-            for mm in range(len(rgp["label"])):
-                cv_im.append(np.sum(convex_hull_image((spts_track[tt] == rgp["label"][mm]).astype(np.uint8))))          # for each label determine the convex hull image area
-            solidity  =  np.asarray(cv_im) / rgp["area"]                                                                # two spots far from each other have a convew hull image bigger than the sum of the bare spots
-            idxs2wrk  =  np.where(solidity > solidity_thr)[0]                                                           # for a solid spot sld = 1; when sld higher than one, the spots is split in several connected components.
+        tlen         =  spts_track.shape[0]                                                                             # number of time frames
+        cpu_owe      =  min(workers.processes, 16)                                                                      # number of cpu (maximum of 16 for Virginia pc)
+        spts_shared  =  workers.share(spts_track)                                                                       # workers read the tracked spots from shared memory, no copy
+        jobs_args    =  []                                                                                              # initialize the list of the arguments
+        sub_frames   =  [sub for sub in np.array_split(np.arange(tlen), cpu_owe) if sub.size > 0]                       # split the total number of time frames in nearly egual chops
+        for sub in sub_frames:
+            jobs_args.append([spts_shared, sub[0], sub[-1] + 1])                                                        # populate the list
+
+        results  =  workers.map(SolidityTableUtility, jobs_args)
+        workers.release(spts_shared)
+        if own_workers:
+            workers.close()
+
+        frame_size  =  spts_track.shape[1] * spts_track.shape[2]
+        t_offsets   =  [sub[0] for sub in sub_frames]                                                                   # first frame of each chop
+        row_offset  =  np.cumsum([0] + [res.solidity.size for res in results])                                          # rows of the table filled by the previous chops
+
+        self.shape      =  spts_track.shape
+        self.dtype      =  spts_track.dtype
+        self.t_rows     =  np.concatenate([res.t_rows + t_offsets[cnt] for cnt, res in enumerate(results)])            # frame, label and solidity of each (frame, spot) row of the table
+        self.lbl_rows   =  np.concatenate([res.lbl_rows for res in results])
+        self.solidity   =  np.concatenate([res.solidity for res in results])
+        self.rm_coords  =  np.concatenate([res.rm_coords + t_offsets[cnt] * frame_size for cnt, res in enumerate(results)])    # flat coordinates of the pixels out of the biggest connected component of their spot
+        self.rm_rows    =  np.concatenate([res.rm_rows + row_offset[cnt] for cnt, res in enumerate(results)])          # row of the table of each of these pixels
+
+    def spts2rm(self, solidity_thr):
+        """Matrix of the spots to remove for a given solidity threshold."""
+        rm_sel   =  self.solidity[self.rm_rows] > solidity_thr                                                          # for a solid spot sld = 1; when sld higher than one, the spots is split in several connected components.
                                                                                                                         # Tuning the threshold is possible to differentiate between sister chromatids and detection errors.
                                                                                                                         # Even for a solid single spot you can have this ratio slightly higher: happens since spots are not regular
-            for idx2wrk in idxs2wrk:                                                                                    # for each of the high sld spots
-                spt      =  (spts_track[tt] == rgp["label"][idx2wrk]) * 1                                               # isolate it
-                spt_lbl  =  label(spt)                                                                                  # label it
-                if spt_lbl.max() > 1:                                                                                   # if there is more than 1 label
-                    rgp_spt   =  regionprops_table(spt_lbl, properties=["label", "area"])                               # regionprop to measure area
-                    idxs_bff  =  list(np.arange(spt_lbl.max()))                                                         # list of the indexes of the identified connected components
-                    idxs_bff.remove(np.argmax(rgp_spt["area"]))                                                         # remove from the list the index of the connectedc component with bigger surface
-                    for idx_bff in idxs_bff:
-                        spts2rm[tt]  +=  spt_lbl == rgp_spt["label"][idx_bff]                                           # add to the final matrix the spots to be removed
+        spts2rm  =  np.zeros(self.shape, dtype=self.dtype)
+        spts2rm.reshape(-1)[self.rm_coords[rm_sel]]  =  1                                                               # remove all the connected components but the biggest one of the selected spots
+        return spts2rm
+
+
+class SolidityTableUtility:
+    """Solidity and connected components of the spots in a chop of frames, for multiprocessing purposes."""
+    def __init__(self, job_args):
 
-        self.spts2rm  =  spts2rm
+        spts_track  =  SharedWorkerPool.attach(job_args[0])[job_args[1]:job_args[2]]                                   # chop of frames to work on, read from shared memory
+        t_rows      =  []
+        lbl_rows    =  []
+        solidity    =  []
+        rm_coords   =  []
+        rm_rows     =  []
+        row_offset  =  0
+
+        for tt in range(spts_track.shape[0]):
+            rgp       =  regionprops_table(spts_track[tt], properties=["label", "area", "area_convex"])                 # regionprops of the tracked spots, convex hulls are measured on each spot bounding box
+            cc_lbl    =  label(spts_track[tt])                                                                          # connected components of all the spots at once: touching pixels of different spots are never connected
+            cc_areas  =  np.bincount(cc_lbl.ravel())                                                                    # area of each connected component
+            cc_spt    =  np.zeros(cc_areas.size, dtype=spts_track.dtype)
+            cc_spt[cc_lbl.ravel()]  =  spts_track[tt].ravel()                                                           # spot label of each connected component
+            cc_row                  =  np.searchsorted(rgp["label"], cc_spt[1:])                                        # row of the table of each connected component
+
+            cc_order          =  np.lexsort((np.arange(cc_row.size), -cc_areas[1:], cc_row))                           # components sorted by spot, by decreasing area and, for equal areas, by label
+            cc_rm             =  np.ones(cc_areas.size, dtype=bool)
+            cc_rm[0]          =  False
+            cc_rm[1 + cc_order[np.diff(cc_row[cc_order], prepend=-1) != 0]]  =  False                              # the first component of each spot is its biggest one, to keep
+            frame_rm_coords   =  np.flatnonzero(cc_rm[cc_lbl])
+
+            t_rows.append(np.full(rgp["label"].size, tt))
+            lbl_rows.append(rgp["label"])
+            solidity.append(rgp["area_convex"] / rgp["area"])                                                          # two spots far from each other have a convew hull image bigger than the sum of the bare spots
+            rm_coords.append(frame_rm_coords + tt * cc_lbl.size)
+            rm_rows.append(cc_row[cc_lbl.ravel()[frame_rm_coords] - 1] + row_offset)
+            row_offset  +=  rgp["label"].size
+
+        self.t_rows     =  np.concatenate(t_rows + [np.zeros(0, dtype=int)])
+        self.lbl_rows   =  np.concatenate(lbl_rows + [np.zeros(0, dtype=spts_track.dtype)])
+        self.solidity   =  np.concatenate(solidity + [np.zeros(0)])
+        self.rm_coords  =  np.concatenate(rm_coords + [np.zeros(0, dtype=np.int64)])
+        self.rm_rows    =  np.concatenate(rm_rows + [np.zeros(0, dtype=np.int64)])
 
 
 class FilteredSpots2Save:
     """Organize filtered spots in a class with attributes as in the Chopper Spots detector."""
     def __init__(self, analysis_folder, spts2rm):
 
-        self.spots_ints   =  np.load(analysis_folder + '/spots_3D_ints.npy') * (1 - spts2rm)                            # load ints matrices and remove the spots to remove
-        self.spots_vol    =  np.load(analysis_folder + '/spots_3D_vol.npy') * (1 - spts2rm)                             # load vol matrices and remove the spots to remove
-        spots_coords_old  =  np.load(analysis_folder + '/spots_3D_coords.npy')                                          # load spots_coords old matrix (it will be corrected)
+        rm_coords         =  np.nonzero(spts2rm)                                                                        # the filters touch only the pixels of the spots to remove
+        self.spots_ints   =  SparseSpots.open_matrix(analysis_folder, 'spots_3D_ints', mmap_mode="c")                   # copy-on-write memory maps of the .npy files (only the pages of the removed spots are copied in memory), or dense matrices rebuilt from the sparse columns
+        self.spots_vol    =  SparseSpots.open_matrix(analysis_folder, 'spots_3D_vol', mmap_mode="c")
+        self.spots_ints[rm_coords]  =  self.spots_ints[rm_coords] * (1 - spts2rm[rm_coords])                           # remove the spots to remove
+        self.spots_vol[rm_coords]   =  self.spots_vol[rm_coords] * (1 - spts2rm[rm_coords])
+        spots_coords_old  =  np.load(analysis_folder + '/spots_3D_coords.npy', mmap_mode="r")                           # load spots_coords old matrix (it will be corrected)
 
         spots_coords  =  np.zeros((0, 4), dtype=np.int16)                                                               # initialize spots_coords matrix
         spots_tzxy    =  np.zeros((0, 4), dtype=np.int16)                                                               # initialize spots_tzxy matrix
@@ -102,62 +146,45 @@ class FilteredSpots2Save:
 
 class RemoveIsolatedSpots:
     """Remove spots appearing only from an isolated frames."""
-    def __init__(self, spts_track, numb_zeros_frst_value, numb_zeros_scnd_value, numb_zeros_thrd_value, slot_strt_frst_value, slot_end_frst_value, slot_strt_scnd_value, slot_end_scnd_value, slot_strt_thrd_value, slot_end_thrd_value):
-
-        spts2rm    =  np.zeros_like(spts_track)                                                                         # initialize spots to remove matrix
-        spts_idxs  =  np.unique(spts_track[spts_track != 0])                                                            # indexes of the tracked spots
-        pbar       =  ProgressBar(total1=spts_idxs.size)
-        pbar.show()
-
-        for cnt, spt_idx in enumerate(spts_idxs):                                                                       # for each spot
-            pbar.update_progressbar(cnt)
-            prof  =  np.sign(np.sum(spts_track == spt_idx, axis=(1, 2)))                                                # 0/1 profile (active-inactive)
-
-            prof1       =  np.concatenate([np.zeros(numb_zeros_frst_value), prof[slot_strt_frst_value:slot_end_frst_value]])     # padd numb_zeros_frst zeros at the beginning to deal with isolated spot at the beginning
-            test_list1  =  list(np.concatenate([np.zeros(numb_zeros_frst_value, dtype=np.int64), np.array([1]), np.zeros(numb_zeros_frst_value, dtype=np.int64)]))  # pattern of active inactive to search for in the profile
-            t2rm1       =  [i for i in range(0, len(prof1)) if list(prof1[i:i + 1 + 2 * numb_zeros_frst_value]) == test_list1]              # search for the pattern in the profile time series
-            for tt in t2rm1:
-                spts2rm[tt]  +=  (spts_track[tt] == spt_idx)                                  # remove the spot in the isolated active frame
-
-            prof2       =  prof[slot_strt_scnd_value - numb_zeros_scnd_value:slot_end_scnd_value]           # take num_of_zeros frames before too to avoid the filter to not work properly across the region changes
-            test_list2  =  list(np.concatenate([np.zeros(numb_zeros_scnd_value, dtype=np.int64), np.array([1]), np.zeros(numb_zeros_scnd_value, dtype=np.int64)]))  # pattern of active inactive to search for in the profile
-            t2rm2       =  [i for i in range(0, len(prof2)) if list(prof2[i:i + 1 + 2 * numb_zeros_scnd_value]) == test_list2]              # search for the pattern in the profile time series
-            t2rm2       =  np.asarray(t2rm2) + slot_strt_scnd_value
-            for tt in t2rm2:
-                spts2rm[tt]  +=  (spts_track[tt] == spt_idx)                                  # remove the spot in the isolated active frame
-
-            prof3       =  np.concatenate([prof[slot_strt_thrd_value - numb_zeros_thrd_value:slot_end_thrd_value], np.zeros(numb_zeros_thrd_value)])    # take numb_of_zeros frames before to avoid the filter to not work across region changes and pass numb_of_zeros after to delete isolated last activations
-            test_list3  =  list(np.concatenate([np.zeros(numb_zeros_thrd_value, dtype=np.int64), np.array([1]), np.zeros(numb_zeros_thrd_value, dtype=np.int64)]))  # pattern of active inactive to search for in the profile
-            t2rm3       =  [i for i in range(0, len(prof1)) if list(prof3[i:i + 1 + 2 * numb_zeros_thrd_value]) == test_list3]              # search for the pattern in the profile time series
-            t2rm3       =  np.asarray(t2rm3) + slot_strt_thrd_value
-            for tt in t2rm3:
-                spts2rm[tt]  +=  (spts_track[tt] == spt_idx)                                  # remove the spot in the isolated active frame
-
-        pbar.close()
-        self.spts2rm  =  spts2rm
-
-
-class ProgressBar(QtWidgets.QWidget):
-    """Simple progressbar widget."""
-    def __init__(self, parent=None, total1=20):
-        super().__init__(parent)
-        self.name_line1  =  QtWidgets.QLineEdit()
-
-        self.progressbar1  =  QtWidgets.QProgressBar()
-        self.progressbar1.setMinimum(1)
-        self.progressbar1.setMaximum(total1)
-
-        main_layout  =  QtWidgets.QGridLayout()
-        main_layout.addWidget(self.progressbar1, 0, 0)
-
-        self.setLayout(main_layout)
-        self.setWindowTitle("Progress")
-        self.setGeometry(500, 300, 300, 50)
-
-    def update_progressbar(self, val1):
-        """Update progressbar."""
-        self.progressbar1.setValue(val1)
-        QtWidgets.qApp.processEvents()
+    def __init__(self, spts_track, numb_zeros_frst_value, numb_zeros_scnd_value, numb_zeros_thrd_value, slot_strt_frst_value, slot_end_frst_value, slot_strt_scnd_value, slot_end_scnd_value, slot_strt_thrd_value, slot_end_thrd_value, spts_index=None):
+
+        if spts_index is None:
+            spts_index  =  SpotsPixelIndex.SpotsPixelIndex(spts_track)                                                  # sparse index of the spots pixels (built here if not shared by the caller)
+
+        prof       =  spts_index.activity_matrix()                                                                      # spots x time 0/1 activity matrix
+        n_spts     =  prof.shape[0]
+        rm_counts  =  np.zeros(prof.shape, dtype=np.int64)                                                              # number of times each spot is tagged for removal in each frame
+
+        prof1         =  np.concatenate([np.zeros((n_spts, numb_zeros_frst_value), dtype=prof.dtype), prof[:, slot_strt_frst_value:slot_end_frst_value]], axis=1)     # padd numb_zeros_frst zeros at the beginning to deal with isolated spot at the beginning
+        rows1, t2rm1  =  isolated_activations(prof1, numb_zeros_frst_value, prof1.shape[1])                            # search for the pattern in the profile time series
+        np.add.at(rm_counts, (rows1, t2rm1), 1)
+
+        prof2         =  prof[:, slot_strt_scnd_value - numb_zeros_scnd_value:slot_end_scnd_value]                     # take num_of_zeros frames before too to avoid the filter to not work properly across the region changes
+        rows2, t2rm2  =  isolated_activations(prof2, numb_zeros_scnd_value, prof2.shape[1])                            # search for the pattern in the profile time series
+        np.add.at(rm_counts, (rows2, t2rm2 + slot_strt_scnd_value), 1)
+
+        prof3         =  np.concatenate([prof[:, slot_strt_thrd_value - numb_zeros_thrd_value:slot_end_thrd_value], np.zeros((n_spts, numb_zeros_thrd_value), dtype=prof.dtype)], axis=1)    # take numb_of_zeros frames before to avoid the filter to not work across region changes and pass numb_of_zeros after to delete isolated last activations
+        rows3, t2rm3  =  isolated_activations(prof3, numb_zeros_thrd_value, prof1.shape[1])                            # search for the pattern in the profile time series (only on the first len(prof1) positions)
+        np.add.at(rm_counts, (rows3, t2rm3 + slot_strt_thrd_value), 1)
+
+        self.spts2rm  =  spts_index.write_back(rm_counts).astype(spts_track.dtype, copy=False)                          # remove the spots in the isolated active frames with a single lookup
+
+
+def isolated_activations(prof_mtx, numb_zeros, numb_starts):
+    """Find the 'numb_zeros zeros / 1 / numb_zeros zeros' patterns in all the rows of a 0/1 profiles matrix at once.
+
+    Returns rows and starting positions of the matching windows; only windows starting before numb_starts and entirely inside the profiles are considered.
+    """
+    wind_len   =  2 * numb_zeros + 1
+    n_windows  =  min(numb_starts, prof_mtx.shape[1] - wind_len + 1)                                                    # number of complete windows to test
+    if n_windows <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    prof_cumsum  =  np.zeros((prof_mtx.shape[0], prof_mtx.shape[1] + 1), dtype=np.int64)
+    np.cumsum(prof_mtx, axis=1, out=prof_cumsum[:, 1:])
+    wind_sums    =  prof_cumsum[:, wind_len:wind_len + n_windows] - prof_cumsum[:, :n_windows]                          # number of active frames in each window
+    rows, strts  =  np.nonzero((wind_sums == 1) & (prof_mtx[:, numb_zeros:numb_zeros + n_windows] == 1))              # a single activation, placed in the middle of the window
+    return rows, strts
 
 
         # for cnt, spt_idx in enumerate(spts_idxs):                                                                       # for each spot
@@ -0,0 +1,16 @@
+"""This function splits a movie in windows of frames fitting a memory budget.
+
+It is used by the out-of-core mode: the raw movie is decoded on disk and
+loading and saving work on a window of frames at a time, with windows as big as
+the memory budget allows.
+"""
+
+
+def chunk_frames(frame_nbytes, memory_budget):
+    """Number of frames of a window: as many as the budget allows, at least one."""
+    return int(max(memory_budget // max(frame_nbytes, 1), 1))
+
+
+def time_chunks(steps, n_frames):
+    """First and last (excluded) frame of each window."""
+    return [[t0, min(t0 + n_frames, steps)] for t0 in range(0, steps, n_frames)]
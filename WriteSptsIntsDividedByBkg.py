@@ -5,44 +5,50 @@ background value of each spot in each frame (using cages) and
 subtracte it from the intensity of the spot. The background value
 is multiplied by the volume of the spots of course. results
 written in a .xls file.
+Mean and standard deviation of each cage come from the integral images
+of the stack and of its square, so that cages of close spots can overlap
+without interfering.
 """
 
 import datetime
-import multiprocessing
 import numpy as np
-from skimage.measure import regionprops, regionprops_table
+from skimage.measure import regionprops_table
 import xlsxwriter
 
+import SharedWorkerPool
+
 
 class WriteSptsIntsDividedByBkg:
     """Main class that calculates the background value for each nucleus and writes results into excel file"""
-    def __init__(self, foldername, green4D, spots_3D, spots_tracked_3D):
+    def __init__(self, foldername, green4D, spots_3D, spots_tracked_3D, workers=None):
 
         spts_id  =  spots_tracked_3D[spots_tracked_3D != 0]
         spts_id  =  np.unique(spts_id).astype(np.uint16)
         steps    =  spots_tracked_3D.shape[0]
 
-        cpu_ow     =  multiprocessing.cpu_count()
-        jobs_args  =  []
-        t_chops    =  np.linspace(0, steps, cpu_ow).astype(int)
-        for k in range(cpu_ow - 1):
-            jobs_args.append([green4D[t_chops[k]:t_chops[k + 1], :, :, :], spots_3D.spots_ints[t_chops[k]:t_chops[k + 1], :, :], spots_3D.spots_vol[t_chops[k]:t_chops[k + 1], :, :], spots_tracked_3D[t_chops[k]:t_chops[k + 1], :, :], spts_id])
-
-        pool     =  multiprocessing.Pool()
-        results  =  pool.map(WriteSptsIntsDividedByBkgUtility, jobs_args)
-        pool.close()
-
-        spts_int_bybkg     =  results[0].spts_int_bybkg
-        av_spts_int_bybkg  =  results[0].av_spts_int_bybkg
-        bkg                =  results[0].bkg
-        bkg_variab         =  results[0].bkg_variab
-        for j in range(1, cpu_ow - 1):
-            spts_int_bybkg     =  np.concatenate((spts_int_bybkg, results[j].spts_int_bybkg), axis=1)
-            bkg                =  np.concatenate((bkg, results[j].bkg), axis=1)
-            bkg_variab         =  np.concatenate((bkg_variab, results[j].bkg_variab), axis=1)
-            av_spts_int_bybkg  =  np.concatenate((av_spts_int_bybkg, results[j].av_spts_int_bybkg), axis=1)
-
-        del results
+        own_workers  =  workers is None
+        if own_workers:
+            workers  =  SharedWorkerPool.SharedWorkerPool()                         # launch a multiprocessing pool just for this job
+
+        shared_mtxs   =  [workers.share(green4D), workers.share(spots_3D.spots_ints), workers.share(spots_3D.spots_vol), workers.share(spots_tracked_3D)]     # workers read the matrices from shared memory, no copy
+        spts_t_count  =  np.array([np.unique(spots_tracked_3D[t]).size - 1 for t in range(steps)])                 # number of spots in each frame: it gives the cost of the frame
+        frames_load   =  spts_t_count + (spts_t_count > 0) * spts_t_count.mean()                                    # the integral images give a fixed cost to each frame with spots
+        t_chops       =  SharedWorkerPool.balanced_chunks(frames_load, 4 * workers.processes)                      # several work units per worker, fed dynamically
+        jobs_args     =  [[shared_mtxs, t_chops[k], t_chops[k + 1], spts_id] for k in range(t_chops.size - 1)]
+
+        spts_int_bybkg     =  np.zeros((spts_id.size, steps))
+        av_spts_int_bybkg  =  np.zeros((spts_id.size, steps))
+        bkg                =  np.zeros((spts_id.size, steps, 2))
+        bkg_variab         =  np.zeros((spts_id.size, steps))
+        for result in workers.imap_unordered(WriteSptsIntsDividedByBkgUtility, jobs_args):                         # results are merged by frame index as soon as they come
+            spts_int_bybkg[:, result.t0:result.t1]     =  result.spts_int_bybkg
+            av_spts_int_bybkg[:, result.t0:result.t1]  =  result.av_spts_int_bybkg
+            bkg[:, result.t0:result.t1]                =  result.bkg
+            bkg_variab[:, result.t0:result.t1]         =  result.bkg_variab
+
+        workers.release(*shared_mtxs)
+        if own_workers:
+            workers.close()
 
         spts_int_bybkg[np.isnan(spts_int_bybkg)]        =  0
         av_spts_int_bybkg[np.isnan(av_spts_int_bybkg)]  =  0
@@ -84,8 +90,9 @@ class WriteSptsIntsDividedByBkg:
 
 class WriteSptsIntsDividedByBkgUtility:
     """Calculate background cells in smalle regions, for multiprocessing pourposes"""
-    def __init__(self, input_args):                      # list is made by raw data, ints data, vol data, tag data, tag list
+    def __init__(self, job_args):                        # list is made by shared raw data, ints data, vol data and tag data, first and last (excluded) frames, tag list
 
+        input_args                  =  [mtx[job_args[1]:job_args[2]] for mtx in SharedWorkerPool.attach(*job_args[0])] + [job_args[3]]
         steps, z_tot, x_tot, y_tot  =  input_args[0].shape
         spts_int_bybkg              =  np.zeros((input_args[4].size, steps))
         av_spts_int_bybkg           =  np.zeros((input_args[4].size, steps))
@@ -93,47 +100,60 @@ class WriteSptsIntsDividedByBkgUtility:
         bkg_variab                  =  np.zeros((input_args[4].size, steps))
 
         for t in range(steps):
-            rgp_spts      =  regionprops(input_args[3][t].astype(np.uint16))
-            bkg_tags      =  np.zeros(input_args[0][t].shape, dtype=np.uint16)
-            for j in range(len(rgp_spts)):
-                x_ctr, y_ctr  =  rgp_spts[j]['centroid']
-                x_ctr, y_ctr  =  int(round(x_ctr)), int(round(y_ctr))
-                z_ctr         =  np.argmax(input_args[0][t, :, x_ctr, y_ctr])                        # z center coordinate
-
-                z_min_ext  =  np.max([z_ctr - 5, 0])                                           # edges of the cage, internal and external. Controls for spots close to the borders
-                z_max_ext  =  np.min([z_ctr + 6, z_tot])                                       # in zed the edge is smaller beacause in z the step is smaller than in x or y
-                z_min_int  =  np.max([z_ctr - 3, 0])
-                z_max_int  =  np.min([z_ctr + 4, z_tot])
-
-                x_min_ext  =  np.max([x_ctr - 9, 0])
-                x_max_ext  =  np.min([x_ctr + 10, x_tot])
-                x_min_int  =  np.max([x_ctr - 7, 0])
-                x_max_int  =  np.min([x_ctr + 8, x_tot])
-
-                y_min_ext  =  np.max([y_ctr - 9, 0])
-                y_max_ext  =  np.min([y_ctr + 10, y_tot])
-                y_min_int  =  np.max([y_ctr - 7, 0])
-                y_max_int  =  np.min([y_ctr + 8, y_tot])
-
-                bkg_tags[z_min_ext:z_max_ext, x_min_ext:x_max_ext, y_min_ext:y_max_ext]  =  rgp_spts[j]["label"]                # cage definition (contains more than 1400 pixels)
-                bkg_tags[z_min_int:z_max_int, x_min_int:x_max_int, y_min_int:y_max_int]  =  0
-                bkg[np.where(input_args[4] == rgp_spts[j]["label"])[0][0], t, 1]         =  z_ctr
-
-            try:
-                rgp_cages  =  regionprops_table(bkg_tags, input_args[0][t], properties=["label", "intensity_image"])
-                for count, lbl in enumerate(rgp_cages["label"]):
-                    cages_ints                     =  rgp_cages["intensity_image"][count]
-                    cages_ints                     =  cages_ints[cages_ints != 0]
-                    idx_tag                        =  np.where(input_args[4] == lbl)[0][0]
-                    spts_int_bybkg[idx_tag, t]     =  np.sum(input_args[1][t] * (input_args[3][t] == lbl)) / np.mean(cages_ints)
-                    av_spts_int_bybkg[idx_tag, t]  =  spts_int_bybkg[idx_tag, t] / np.sum(input_args[2][t] * (input_args[3][t] == lbl))
-                    bkg[idx_tag, t, 0]             =  cages_ints.mean()
-                    bkg_variab[idx_tag, t]         =  cages_ints.std()
-
-            except IndexError:                                                                                                      # in case of empty frames
-                pass
-
+            rgp_spts  =  regionprops_table(input_args[3][t].astype(np.uint16), properties=["label", "centroid"])
+            if rgp_spts["label"].size == 0:                                                                             # empty frame
+                continue
+
+            x_ctr    =  np.round(rgp_spts["centroid-0"]).astype(int)
+            y_ctr    =  np.round(rgp_spts["centroid-1"]).astype(int)
+            z_ctr    =  np.argmax(input_args[0][t][:, x_ctr, y_ctr], axis=0)                                           # z center coordinate
+            idx_tag  =  np.searchsorted(input_args[4], rgp_spts["label"])
+
+            z_ext  =  np.maximum(z_ctr - 5, 0), np.minimum(z_ctr + 6, z_tot)                                           # edges of the cage, internal and external. Controls for spots close to the borders
+            z_int  =  np.maximum(z_ctr - 3, 0), np.minimum(z_ctr + 4, z_tot)                                           # in zed the edge is smaller beacause in z the step is smaller than in x or y
+            x_ext  =  np.maximum(x_ctr - 9, 0), np.minimum(x_ctr + 10, x_tot)
+            x_int  =  np.maximum(x_ctr - 7, 0), np.minimum(x_ctr + 8, x_tot)
+            y_ext  =  np.maximum(y_ctr - 9, 0), np.minimum(y_ctr + 10, y_tot)
+            y_int  =  np.maximum(y_ctr - 7, 0), np.minimum(y_ctr + 8, y_tot)
+
+            raw_sat     =  summed_area_table(input_args[0][t], 1)                                                       # integral images of the stack and of its square: each cage is given by few lookups
+            raw2_sat    =  summed_area_table(input_args[0][t], 2)
+            cages_sum   =  box_sums(raw_sat, z_ext, x_ext, y_ext) - box_sums(raw_sat, z_int, x_int, y_int)              # cage: external box minus internal box (more than 1400 pixels)
+            cages_sum2  =  box_sums(raw2_sat, z_ext, x_ext, y_ext) - box_sums(raw2_sat, z_int, x_int, y_int)
+            cages_npix  =  np.prod([z_ext[1] - z_ext[0], x_ext[1] - x_ext[0], y_ext[1] - y_ext[0]], axis=0) - np.prod([z_int[1] - z_int[0], x_int[1] - x_int[0], y_int[1] - y_int[0]], axis=0)
+            cages_mean  =  cages_sum / cages_npix
+            cages_std   =  np.sqrt(np.maximum(cages_sum2 / cages_npix - cages_mean ** 2, 0))
+
+            lbls_rows   =  np.searchsorted(rgp_spts["label"], input_args[3][t])                                         # row of the spot of each pixel of the frame (tags are sorted)
+            spts_pxls   =  input_args[3][t] != 0
+            spts_ints   =  np.bincount(lbls_rows[spts_pxls], weights=input_args[1][t][spts_pxls], minlength=idx_tag.size)     # label-indexed sums of intensity and volume of the spots
+            spts_vol    =  np.bincount(lbls_rows[spts_pxls], weights=input_args[2][t][spts_pxls], minlength=idx_tag.size)
+
+            spts_int_bybkg[idx_tag, t]     =  spts_ints / cages_mean
+            av_spts_int_bybkg[idx_tag, t]  =  spts_int_bybkg[idx_tag, t] / spts_vol
+            bkg[idx_tag, t, 0]             =  cages_mean
+            bkg[idx_tag, t, 1]             =  z_ctr
+            bkg_variab[idx_tag, t]         =  cages_std
+
+        self.t0                 =  job_args[1]
+        self.t1                 =  job_args[2]
         self.spts_int_bybkg     =  spts_int_bybkg
         self.bkg                =  bkg
         self.bkg_variab         =  bkg_variab
         self.av_spts_int_bybkg  =  av_spts_int_bybkg
+
+
+def summed_area_table(stack, power):
+    """3D integral image of a power of the stack, padded with zeros in front of each axis."""
+    acc_dtype        =  np.int64 if np.issubdtype(stack.dtype, np.integer) else np.float64          # exact sums for integer stacks, float stacks (TIFF, some CZI) summed in double precision
+    sat              =  np.zeros((stack.shape[0] + 1, stack.shape[1] + 1, stack.shape[2] + 1), dtype=acc_dtype)
+    sat[1:, 1:, 1:]  =  stack.astype(acc_dtype) ** power
+    for ax in range(3):
+        np.cumsum(sat, axis=ax, out=sat)                                # in place
+    return sat
+
+
+def box_sums(sat, z_lims, x_lims, y_lims):
+    """Sums of the stack in several boxes [min, max) at once, from its integral image."""
+    (z0, z1), (x0, x1), (y0, y1)  =  z_lims, x_lims, y_lims
+    return sat[z1, x1, y1] - sat[z0, x1, y1] - sat[z1, x0, y1] - sat[z1, x1, y0] + sat[z0, x0, y1] + sat[z0, x1, y0] + sat[z1, x0, y0] - sat[z0, x0, y0]
@@ -0,0 +1,86 @@
+"""Tests of the closer nuclei map against the square search of CloserNucleiFinder.
+
+Run with 'python -m pytest test_CloserNucleiFinder.py'.
+"""
+
+
+import numpy as np
+import pytest
+
+import CloserNucleiFinder
+import SpotsConnection
+
+
+MAXDISTS  =  [0.5, 1, 1.5, 2, 3, 3.5, 5, 7.25]
+
+
+def random_nuclei(rng, shape=(32, 41), n_nucs=6, max_side=4):
+    """Frame with a few rectangular nuclei labelled at random, possibly touching each other."""
+    nuclei_lbl  =  np.zeros(shape, dtype=np.uint16)
+    for lbl in rng.choice(np.arange(1, 60), size=n_nucs, replace=False):
+        x0, y0            =  rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        x_side, y_side    =  rng.integers(1, max_side + 1, size=2)
+        nuclei_lbl[x0:x0 + x_side, y0:y0 + y_side]  =  lbl
+    return nuclei_lbl
+
+
+def assert_same_as_finder(nuclei_lbl, spt_nuc_maxdist):
+    """Every pixel of the map has the label found by the square search started there."""
+    mx_map  =  CloserNucleiFinder.CloserNucleiMap(nuclei_lbl, spt_nuc_maxdist).mx_map
+    for x in range(nuclei_lbl.shape[0]):
+        for y in range(nuclei_lbl.shape[1]):
+            assert mx_map[x, y] == CloserNucleiFinder.CloserNucleiFinder(nuclei_lbl, np.array([x, y]), spt_nuc_maxdist).mx_pt, (x, y)
+
+
+@pytest.mark.parametrize("spt_nuc_maxdist", MAXDISTS)
+def test_random_frames(spt_nuc_maxdist):
+    rng  =  np.random.default_rng(int(spt_nuc_maxdist * 100))
+    for _ in range(5):
+        assert_same_as_finder(random_nuclei(rng), spt_nuc_maxdist)
+
+
+@pytest.mark.parametrize("spt_nuc_maxdist", MAXDISTS)
+def test_ties(spt_nuc_maxdist):
+    nuclei_lbl         =  np.zeros((15, 15), dtype=np.uint16)
+    nuclei_lbl[7, 3]   =  4                     # same chessboard distance from the center (7, 7)
+    nuclei_lbl[7, 11]  =  9
+    nuclei_lbl[3, 10]  =  2
+    assert_same_as_finder(nuclei_lbl, spt_nuc_maxdist)
+    if spt_nuc_maxdist > 4:
+        assert CloserNucleiFinder.CloserNucleiMap(nuclei_lbl, spt_nuc_maxdist).mx_map[7, 7] == 9              # ties go to the biggest label
+
+
+@pytest.mark.parametrize("spt_nuc_maxdist", [3, 3.5, 4])
+def test_distance_limit(spt_nuc_maxdist):
+    nuclei_lbl        =  np.zeros((1, 12), dtype=np.uint16)
+    nuclei_lbl[0, 0]  =  5
+    mx_map            =  CloserNucleiFinder.CloserNucleiMap(nuclei_lbl, spt_nuc_maxdist).mx_map
+    side_max          =  int(np.ceil(spt_nuc_maxdist)) - 1
+    assert (mx_map[0, 1:side_max + 1] == 5).all()                                                          # found up to the last side smaller than the maximum distance
+    assert (mx_map[0, side_max + 1:] == 0).all()                                                           # not at the maximum distance and beyond
+    assert_same_as_finder(nuclei_lbl, spt_nuc_maxdist)
+
+
+@pytest.mark.parametrize("spt_nuc_maxdist", [2, 3.5, 6])
+def test_borders(spt_nuc_maxdist):
+    nuclei_lbl          =  np.zeros((9, 11), dtype=np.uint16)
+    nuclei_lbl[0, 0]    =  3                    # nuclei on the corners and the edges of the frame
+    nuclei_lbl[8, 10]   =  7
+    nuclei_lbl[4, 10]   =  1
+    nuclei_lbl[8, 2:4]  =  6
+    assert_same_as_finder(nuclei_lbl, spt_nuc_maxdist)
+
+
+def test_empty_frame():
+    assert_same_as_finder(np.zeros((6, 7), dtype=np.uint16), 4)
+
+
+@pytest.mark.parametrize("spt_nuc_maxdist", [1.5, 3, 4.5])
+def test_spots_connection_engines(spt_nuc_maxdist):
+    rng             =  np.random.default_rng(7)
+    nuclei_tracked  =  np.stack([random_nuclei(rng, n_nucs=8) for _ in range(4)])
+    spots_mask      =  rng.random(nuclei_tracked.shape) > 0.93                                             # small spots, many of them not on a nucleus
+    spots_window    =  SpotsConnection.SpotsConnection(nuclei_tracked, spots_mask, spt_nuc_maxdist, "window").spots_tracked
+    spots_map       =  SpotsConnection.SpotsConnection(nuclei_tracked, spots_mask, spt_nuc_maxdist, "map").spots_tracked
+    assert spots_window.any()
+    np.testing.assert_array_equal(spots_map, spots_window)